@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Usage: make_tree.py <folder> [--files N] [--size-median BYTES] [--size-sigma S] [--duplicates R] [--hardlinks R] [--symlinks R] ...
+#
+# Builds a synthetic tree to benchmark pydelete on. The same arguments and --seed always give the same tree:
+# file sizes follow a lognormal distribution, a --duplicates fraction of the files are copies of an earlier
+# file, a --hardlinks fraction are hardlinks of an earlier file, a --symlinks fraction are symlinks to an earlier
+# file and the rest have random content.
+
+import sys, os, random, argparse, json, math
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from pydelete_utils import human_readable_size
+
+
+def make_directories(root, depth, fanout):
+    """
+    Create a tree of directories
+
+    Return:
+        list:       [directory, ...] every directory, root included
+    """
+    directories = [root]
+    level = [root]
+    for d in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(fanout):
+                directory = parent / f'd{d}_{i}'
+                directory.mkdir(exist_ok = True)
+                next_level.append(directory)
+        directories.extend(next_level)
+        level = next_level
+
+    return directories
+
+def file_size(rng, median, sigma, max_size):
+    """Return a size from a lognormal distribution around median, up to max_size"""
+    return min(int(rng.lognormvariate(math.log(median), sigma)), max_size)
+
+def write_random(path, rng, size, chunk_size = 1024*1024):
+    with open(path, 'wb') as f:
+        while size > 0:
+            n = min(size, chunk_size)
+            f.write(rng.randbytes(n))
+            size -= n
+
+def copy_file(source, path, chunk_size = 1024*1024):
+    with open(source, 'rb') as src, open(path, 'wb') as dst:
+        while data := src.read(chunk_size):
+            dst.write(data)
+
+def make_tree(root, files, size_median, size_sigma, max_size, duplicates, hardlinks, symlinks, depth, fanout, seed):
+    """
+    Fill a directory with files
+
+    Return:
+        dict:       {files, unique, duplicates, hardlinks, symlinks, directories, total_size}
+    """
+    rng = random.Random(seed)
+    root.mkdir(parents = True, exist_ok = True)
+    directories = make_directories(root, depth, fanout)
+
+    stats = {'files': 0, 'unique': 0, 'duplicates': 0, 'hardlinks': 0, 'symlinks': 0, 'directories': len(directories), 'total_size': 0}
+    written = []    # (path, size) of the files with their own content
+
+    for n in range(files):
+        path = rng.choice(directories) / f'f{n}.bin'
+        kind = rng.random()
+
+        if written and kind < duplicates:
+            source, size = rng.choice(written)
+            copy_file(source, path)
+            stats['duplicates'] += 1
+        elif written and kind < duplicates + hardlinks:
+            source, size = rng.choice(written)
+            os.link(source, path)
+            stats['hardlinks'] += 1
+        elif written and kind < duplicates + hardlinks + symlinks:
+            # Relative, the tree can be moved
+            source, size = rng.choice(written)
+            os.symlink(os.path.relpath(source, path.parent), path)
+            stats['symlinks'] += 1
+        else:
+            size = file_size(rng, size_median, size_sigma, max_size)
+            write_random(path, rng, size)
+            written.append((path, size))
+            stats['unique'] += 1
+
+        stats['files'] += 1
+        stats['total_size'] += size
+
+    return stats
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Builds a synthetic tree of files to benchmark pydelete')
+    parser.add_argument('path', type=str, help='directory to create the files in.')
+    parser.add_argument('--files', type=int, help='number of files.', default=10000)
+    parser.add_argument('--size-median', type=int, help='median size of the files in bytes.', default=64*1024)
+    parser.add_argument('--size-sigma', type=float, help='sigma of the lognormal distribution of the sizes.', default=1.5)
+    parser.add_argument('--max-size', type=int, help='maximum size of a file in bytes.', default=256*1024*1024)
+    parser.add_argument('--duplicates', type=float, help='fraction of the files that are copies of another one.', default=0.2)
+    parser.add_argument('--hardlinks', type=float, help='fraction of the files that are hardlinks of another one.', default=0.02)
+    parser.add_argument('--symlinks', type=float, help='fraction of the files that are symlinks to another one.', default=0.01)
+    parser.add_argument('--depth', type=int, help='depth of the directory tree.', default=3)
+    parser.add_argument('--fanout', type=int, help='subdirectories of each directory.', default=4)
+    parser.add_argument('--seed', type=int, help='seed of the random generator.', default=0)
+    parser.add_argument('--json', type=str, help='file to write the parameters and counts of the tree to.', default=None)
+
+    return parser.parse_args()
+
+def main(args):
+    if args.duplicates + args.hardlinks + args.symlinks > 1:
+        print ('--duplicates, --hardlinks and --symlinks add up to more than 1')
+        return 2
+
+    stats = make_tree(Path(args.path), args.files, args.size_median, args.size_sigma, args.max_size, args.duplicates,
+                      args.hardlinks, args.symlinks, args.depth, args.fanout, args.seed)
+
+    print ('Created %d files (%s) in %d directories: %d unique, %d duplicates, %d hardlinks, %d symlinks' % (stats['files'],
+        human_readable_size(stats['total_size']), stats['directories'], stats['unique'], stats['duplicates'], stats['hardlinks'],
+        stats['symlinks']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(json.dumps({'parameters': vars(args), 'tree': stats}, indent=4))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(parse_arguments()))
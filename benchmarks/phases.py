@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Usage: phases.py <folder> [--repeat N] [--algorithm NAME] [--drop-caches] [--json FILE]
+#
+# Times each phase of pydelete on a tree separately: dir_scan, hash_files, check_for_repeated_files,
+# sort_repeated_files_list and write_batch_file. Build a tree with make_tree.py so runs can be compared.
+# Every file that shares its size with another one is hashed in full, the sample stage and the comparisons
+# of run_phases are left out so a change in hash_files shows up as is.
+
+import sys, os, time, argparse, json, tempfile, platform
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from pydelete_utils import human_readable_size, human_readable_datarate
+from fileshasher    import hash_files, algorithms_available
+from pydelete       import (dir_scan, get_file_pos, group_by_inode, group_by_size, check_for_repeated_files,
+                            sort_repeated_files_list, write_batch_file, HASH_ALGORITHM)
+from metrics        import PhasePeak
+from read_order     import drop_caches
+
+
+def timed(results, name, func, files = lambda r: 0, size = lambda r: 0):
+    """
+    Run a phase and add its timings to results
+
+    Parameters:
+        results:    dict to add the {seconds, cpu_seconds, files, bytes, files_per_s, mb_per_s, peak_rss, children_peak_rss}
+                    of the phase to
+        name:       Name of the phase
+        func:       function() running the phase
+        files:      function(result) returning the number of files the phase went through
+        size:       function(result) returning the number of bytes the phase went through
+
+    Return:
+        The return value of func
+    """
+    memory = PhasePeak()
+    memory.start()
+    cpu = time.process_time()
+    start = time.perf_counter()
+    r = func()
+    seconds = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+
+    rss, children_rss = memory.stop()
+    n, nbytes = files(r), size(r)
+    results[name] = {
+        'seconds':      seconds,
+        'cpu_seconds':  cpu,
+        'files':        n,
+        'bytes':        nbytes,
+        'files_per_s':  n / max(seconds, 1e-9),
+        'mb_per_s':     nbytes / max(seconds, 1e-9) / (1024*1024),
+        'peak_rss':     rss,
+        'children_peak_rss': children_rss,
+        }
+
+    return r
+
+def run(path, algorithm, cpu_threads, output_directory):
+    """
+    Go through the phases once
+
+    Return:
+        dict:       { phase: {seconds, cpu_seconds, files, bytes, files_per_s, mb_per_s, peak_rss, children_peak_rss}, ... }
+    """
+    results = {}
+
+    files = timed(results, 'dir_scan',
+                  lambda: dir_scan(path, symlinks = True, abs = True, file_callback = get_file_pos),
+                  lambda r: len(r), lambda r: sum(r.columns['size']))
+    files.sort('pos', 'path')
+
+    # Not timed: they only decide which files get hashed
+    unique, links = group_by_inode(files)
+    candidates, empty_files, size_stats = group_by_size(unique, algorithm)
+
+    hashed = timed(results, 'hash_files',
+                   lambda: hash_files(candidates, cpu_threads, algorithm),
+                   lambda r: len(r), lambda r: sum([item['size'] for item in r]))
+    hashed.extend(empty_files)
+
+    repeated = timed(results, 'check_for_repeated_files',
+                     lambda: check_for_repeated_files(hashed),
+                     lambda r: len(hashed), lambda r: 0)
+
+    repeated = timed(results, 'sort_repeated_files_list',
+                     lambda: sort_repeated_files_list(repeated),
+                     lambda r: sum([len(tuple(group.values())[0]['files']) for group in r]), lambda r: 0)
+
+    # write_batch_file writes to the script name as is
+    script = os.path.join(output_directory, 'replist.sh')
+    timed(results, 'write_batch_file',
+          lambda: write_batch_file(repeated, files, output_directory, script, '.'),
+          lambda r: sum([len(tuple(group.values())[0]['files']) for group in repeated]), lambda r: os.path.getsize(script))
+
+    return results
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Times each phase of pydelete on a tree')
+    parser.add_argument('path', type=str, help='path to scan, see make_tree.py.')
+    parser.add_argument('--repeat', type=int, help='number of runs, the best time of each phase is reported.', default=3)
+    parser.add_argument('--algorithm', type=str, choices=algorithms_available(), metavar='ALGORITHM', help='hash algorithm.', default=HASH_ALGORITHM)
+    parser.add_argument('--threads', type=int, help='hashing processes of each device.', default=os.cpu_count())
+    parser.add_argument('--drop-caches', action='store_true', help='drop the page cache before each run, needs root.')
+    parser.add_argument('--json', type=str, help='file to write the results to.', default=None)
+
+    return parser.parse_args()
+
+def main(args):
+    runs = []
+    with tempfile.TemporaryDirectory() as output_directory:
+        for i in range(args.repeat):
+            if args.drop_caches:
+                drop_caches()
+            runs.append(run(Path(args.path), args.algorithm, args.threads, output_directory))
+            print ()
+
+    # The fastest run of each phase is the one least disturbed by the rest of the system
+    best = {}
+    for name in runs[0]:
+        best[name] = min([r[name] for r in runs], key = lambda x: x['seconds'])
+
+    for name, result in best.items():
+        print ('%-26s %8.3f s %8.3f s cpu %10.0f files/s %10s %10s peak RSS' % (name, result['seconds'], result['cpu_seconds'],
+            result['files_per_s'], human_readable_datarate(result['bytes'] / max(result['seconds'], 1e-9)) if result['bytes'] else '',
+            human_readable_size(result['peak_rss']) if result['peak_rss'] else '?'))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(json.dumps({
+                'parameters': vars(args),
+                'system': {'platform': platform.platform(), 'python': platform.python_version(), 'cpu_count': os.cpu_count()},
+                'best': best,
+                'runs': runs,
+                }, indent=4))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(parse_arguments()))
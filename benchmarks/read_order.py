@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Usage: read_order.py <folder> [--read] [--drop-caches]
+#
+# Compares the order get_file_pos gives to the files using FIEMAP against the inode order.
+# Without --read it only reports the seek distance between consecutive files, with --read it also reads
+# every file in each order and reports the throughput. --drop-caches (root only) empties the page cache
+# before each read pass, otherwise the second pass is served from memory.
+
+import sys, os, time, argparse, json
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from pydelete_utils import human_readable_size, human_readable_datarate
+from pydelete       import scan_tree, get_file_physical
+
+
+def scan(path):
+    """
+    Scan a directory and get the first extent of each file
+
+    Return:
+        list:       [ {path, size, ino, physical}, ... ], physical is None if FIEMAP failed
+    """
+    files = []
+    for item in scan_tree(path, symlinks = False, abs = True):
+        try:
+            item['physical'] = get_file_physical(str(item['path']))['physical']
+        except OSError:
+            item['physical'] = None
+        files.append(item)
+
+    return files
+
+def seek_stats(files):
+    """
+    Measure the head movements needed to read the files in the given order, using their first extent
+
+    Return:
+        dict:       {seeks, backward_seeks, distance}
+    """
+    stats = {'seeks': 0, 'backward_seeks': 0, 'distance': 0}
+
+    end = None
+    for item in files:
+        if not item['physical']:
+            continue
+        if end is not None and item['physical'] != end:
+            stats['seeks'] += 1
+            stats['backward_seeks'] += item['physical'] < end
+            stats['distance'] += abs(item['physical'] - end)
+        end = item['physical'] + item['size']
+
+    return stats
+
+def drop_caches():
+    os.sync()
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3\n')
+
+def read_files(files, chunk_size = 1024*1024):
+    """
+    Read the files in the given order
+
+    Return:
+        dict:       {read_size, seconds}
+    """
+    buffer = memoryview(bytearray(chunk_size))
+    read_size = 0
+
+    start = time.perf_counter()
+    for item in files:
+        try:
+            with open(item['path'], 'rb', buffering = 0) as f:
+                while n := f.readinto(buffer):
+                    read_size += n
+        except OSError as e:
+            print(e)
+
+    return {'read_size': read_size, 'seconds': time.perf_counter() - start}
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Compares the FIEMAP read order against the inode order')
+    parser.add_argument('path', type=str, help='path to scan.')
+    parser.add_argument('--read', action='store_true', help='read the files in each order and time it.')
+    parser.add_argument('--drop-caches', action='store_true', help='drop the page cache before each read pass, needs root.')
+    parser.add_argument('--json', type=str, help='file to write the results to.', default=None)
+
+    return parser.parse_args()
+
+def main(args):
+    files = scan(Path(args.path))
+    mapped = sum([1 for item in files if item['physical'] is not None])
+
+    print ('Found %d files (%s), %d with a FIEMAP extent' % (len(files), human_readable_size(sum([item['size'] for item in files])), mapped))
+    if not mapped:
+        print ('FIEMAP is not supported here, both orders would be the inode order')
+        return 1
+
+    orders = {
+        'inode':    sorted(files, key = lambda x: (x['ino'], str(x['path']))),
+        'fiemap':   sorted(files, key = lambda x: (x['physical'] or 0, str(x['path']))),
+        }
+
+    results = {}
+    for name, order in orders.items():
+        results[name] = seek_stats(order)
+
+        if args.read:
+            if args.drop_caches:
+                drop_caches()
+            results[name].update(read_files(order))
+
+    for name, result in results.items():
+        line = '%-7s %8d seeks, %8d backwards, %s of seek distance' % (name, result['seeks'], result['backward_seeks'],
+                                                                       human_readable_size(result['distance']))
+        if args.read:
+            line += ', %.2f s, %s' % (result['seconds'], human_readable_datarate(result['read_size'] / max(result['seconds'], 1e-9)))
+        print (line)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(json.dumps(results, indent=4))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(parse_arguments()))
@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import queue, threading
+
+from pydelete_utils import is_rotational
+from fileshasher    import file_device, device_readers
+from filetable      import subset_of
+
+# Groups with up to this many files of at least this size get compared instead of hashed
+COMPARE_MAX_FILES   = 3
+COMPARE_MIN_SIZE    = 1024*1024
+
+# First and maximum size of the reads. The reads double each round, files that differ early are dropped after a
+# small read and identical files end up read in big chunks, a spinning disk seeks less going from one to another.
+COMPARE_FIRST_CHUNK = 64*1024
+COMPARE_MAX_CHUNK   = 8*1024*1024
+
+
+def split_for_compare(files, max_files = COMPARE_MAX_FILES, min_size = COMPARE_MIN_SIZE):
+    """
+    Pick for each group of files with the same size if they get hashed or compared
+
+    Comparing reads the files of a group at the same time and stops as soon as they differ, it pays off for
+    a few big files. Big groups are hashed, each file gets read once no matter how many others it is compared with.
+
+    Parameters:
+        files:          List of {path, size} entries. Should only contain files sharing their size with other ones.
+        max_files:      Groups with up to this many files get compared, 0 to hash everything
+        min_size:       Only files of at least this size get compared
+
+    Return:
+        tuple:          ( [ [{path, size}, ...], ... ] groups to compare, [ {path, size}, ... ] files to hash )
+                        The files to hash of a FileTable are FileRows
+    """
+    # Count the files of each size first, only the few groups that get compared are kept as lists
+    sizes = {}
+    for item in files:
+        sizes[item['size']] = sizes.get(item['size'], 0) + 1
+
+    groups = {}
+    to_hash = subset_of(files)
+    for item in files:
+        n = sizes[item['size']]
+        if 2 <= n <= max_files and item['size'] >= min_size:
+            groups.setdefault(item['size'], []).append(item)
+        else:
+            to_hash.append(item)
+
+    return list(groups.values()), to_hash
+
+def _read_chunk(file_obj, buffer):
+    """Fill a buffer from a file, return the number of bytes read. Less than the buffer only at the end of the file."""
+    n = 0
+    while n < len(buffer):
+        r = file_obj.readinto(buffer[n:])
+        if not r:
+            break
+        n += r
+    return n
+
+def compare_files(files, max_chunk_size = COMPARE_MAX_CHUNK):
+    """
+    Compare files of the same size reading them in lockstep
+
+    The files are split in subgroups as soon as their content differs, and a subgroup left with a single file
+    stops being read. Files that can't be read or whose size changed get an 'error' and are left out.
+
+    Parameters:
+        files:          [ {path, size}, ... ] all of the same size
+        max_chunk_size: Maximum size of the reads
+
+    Return:
+        tuple:          ( [ [{path, size}, ...], ... ] groups of identical files, read_size )
+    """
+    chunk_size = min(COMPARE_FIRST_CHUNK, max_chunk_size)
+    read_size = 0
+    identical = []
+
+    # [item, file, bytes read]
+    opened = []
+    for item in files:
+        try:
+            opened.append([item, open(item['path'], 'rb', buffering=0), 0])
+        except OSError as e:
+            msg = f'Error reading data: {item["path"]} \n{e}'
+            print(msg)
+            item['error'] = [msg]
+
+    groups = [opened]
+    buffers = {}
+
+    try:
+        while groups:
+            next_groups = []
+
+            for group in groups:
+                if len(group) < 2:
+                    continue
+
+                # Split the group by the content of the next chunk, comparing each one against the first of each subgroup
+                subgroups = []    # [ (data, [entries]), ... ]
+                for i, entry in enumerate(group):
+                    if i not in buffers or len(buffers[i]) != chunk_size:
+                        buffers[i] = memoryview(bytearray(chunk_size))
+                    try:
+                        n = _read_chunk(entry[1], buffers[i])
+                    except OSError as e:
+                        msg = f'Error reading data: {entry[0]["path"]} \n{e}'
+                        print(msg)
+                        entry[0]['error'] = [msg]
+                        continue
+
+                    entry[2] += n
+                    read_size += n
+                    data = buffers[i][:n]
+
+                    for reference, subgroup in subgroups:
+                        if reference == data:
+                            subgroup.append(entry)
+                            break
+                    else:
+                        subgroups.append((bytes(data), [entry]))
+
+                for data, subgroup in subgroups:
+                    if len(subgroup) < 2:
+                        continue
+
+                    if data:
+                        next_groups.append(subgroup)
+                        continue
+
+                    # End of the files, check their size didn't change in the inbetween
+                    same = []
+                    for item, file_obj, n in subgroup:
+                        if n != item['size']:
+                            msg = f'File size changed from {item["size"]} to {n}: {item["path"]}'
+                            print(msg)
+                            item['error'] = [msg]
+                        else:
+                            same.append(item)
+                    if len(same) > 1:
+                        identical.append(same)
+
+            groups = next_groups
+            chunk_size = min(chunk_size*2, max_chunk_size)
+
+    finally:
+        for item, file_obj, n in opened:
+            file_obj.close()
+
+    return identical, read_size
+
+def compare_groups(groups, cpu_threads, chunk_size = 1024*1024, **kwargs):
+    """
+    Compare groups of files of the same size with a pool of threads for each device
+
+    A spinning disk gets device_readers() threads and reads up to COMPARE_MAX_CHUNK at once, the other devices
+    get cpu_threads and read up to chunk_size.
+
+    Parameters:
+        groups:         [ [{path, size}, ...], ... ]
+        cpu_threads:    Threads of each device that isn't a spinning disk
+        chunk_size:     Maximum size of the reads on devices that aren't spinning disks
+        kwargs:         Other read options, ignored
+
+    Return:
+        tuple:          ( [ [{path, size, hash, hash_algorithm}, ...], ... ] groups of identical files, read_size )
+                        The files of each group get the same made up hash, 'compare:<size>:<dev>:<ino>' of the first
+                        path of the group, and 'compare' as hash_algorithm so check_for_repeated_files groups them like
+                        hashed files. It isn't a digest, write_report leaves it out.
+    """
+    devices = {}
+    for group in groups:
+        devices.setdefault(file_device(group[0]), queue.Queue()).put(group)
+
+    identical = []
+    read_size = [0]
+    lock = threading.Lock()
+
+    def worker(work_queue, max_chunk_size):
+        while True:
+            try:
+                group = work_queue.get_nowait()
+            except queue.Empty:
+                return
+
+            same, n = compare_files(group, max_chunk_size)
+            with lock:
+                identical.extend(same)
+                read_size[0] += n
+
+    pool = []
+    for dev, work_queue in devices.items():
+        max_chunk_size = COMPARE_MAX_CHUNK if is_rotational(dev) else chunk_size
+        for i in range(min(device_readers(dev, cpu_threads), work_queue.qsize())):
+            pool.append(threading.Thread(target=worker, args=[work_queue, max_chunk_size], daemon=True, name=f'compare-{len(pool)}'))
+
+    for thread in pool: thread.start()
+    for thread in pool: thread.join()
+
+    for group in identical:
+        group.sort(key = lambda item: str(item['path']))
+        first = group[0]
+        for item in group:
+            item.update({'hash': f'compare:{first["size"]}:{first["dev"]}:{first["ino"]}', 'hash_algorithm': 'compare'})
+    identical.sort(key = lambda group: (group[0]['size'], str(group[0]['path'])))
+
+    return identical, read_size[0]
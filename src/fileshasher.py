@@ -1,7 +1,7 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-import os, sys, hashlib
+import os, sys, time, mmap, zlib, hashlib, cProfile
 
 import queue
 import psutil
@@ -9,38 +9,267 @@ import psutil
 import multiprocessing, threading
 
 from threading import Thread
-from multiprocessing import Process, Value, Queue
+from multiprocessing import Process, Value, Queue, Pipe, shared_memory
+from multiprocessing.connection import wait
 # multiprocessing is fucked up on windows
 
-from pydelete_utils import timed_tigger, split_list
+from pydelete_utils import timed_tigger, is_rotational
+from filetable import subset_of
 from multiprogressbar import *
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+class Crc32Hash():
+    """hashlib like wrapper of zlib.crc32, the fast algorithm available without extra modules"""
+
+    name = 'crc32'
+    digest_size = 4
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self):
+        return self.value.to_bytes(4, 'big')
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+
+# Non cryptographic algorithms. Fast, but digests of different files can collide so repeated files found
+# with them should be confirmed with a cryptographic algorithm.
+FAST_ALGORITHMS = {'crc32': Crc32Hash}
+if xxhash:
+    FAST_ALGORITHMS.update({ name: getattr(xxhash, name) for name in ('xxh3_64', 'xxh3_128', 'xxh64', 'xxh128') if hasattr(xxhash, name) })
+
+def algorithms_available():
+    """Return the names of the algorithms new_hasher() supports"""
+    # shake algorithms need a digest length, leave them out
+    return sorted([name for name in hashlib.algorithms_available if not name.startswith('shake')] + list(FAST_ALGORITHMS.keys()))
+
+def new_hasher(algorithm):
+    """Return a new hash object with update() and digest() for any algorithm of algorithms_available()"""
+    if algorithm in FAST_ALGORITHMS:
+        return FAST_ALGORITHMS[algorithm]()
+    return hashlib.new(algorithm)
+
+
+def expected_read(size, sample_size = 0):
+    """Return the number of bytes that have to be read to hash a file. Files smaller than two samples get read whole."""
+    if sample_size and size > 2*sample_size:
+        return 2*sample_size
+    return size
+
+
+# Readers of a spinning disk, more than one makes it seek between files
+ROTATIONAL_READERS = 1
+
+def make_batches(files, workers, batch_files = 64, batch_size = 64*1024*1024, ordered = False):
+    """
+    Split a list of files in batches for a work queue shared by several workers.
+
+    Files of at least batch_size go first, biggest first and one per batch, so they get spread between the workers
+    from the start. The rest keep their order and get grouped up to batch_files files or batch_size bytes, these
+    small batches fill the gaps at the end.
+
+    Parameters:
+        files:          List of {path, size} entries
+        workers:        Number of workers sharing the queue
+        batch_files:    Maximum number of files in a batch
+        batch_size:     Maximum number of bytes in a batch
+        ordered:        Keep all the files in their order, for a spinning disk read in disk position order
+
+    Return:
+        List:          [ [{path, size}, ...], ... ] the batches of the rows of a FileTable are FileRows
+    """
+    # Don't make batches so big that some workers would get nothing
+    batch_files = max(1, min(batch_files, len(files) // (workers*4)))
+
+    big = [] if ordered else sorted([item for item in files if item['size'] >= batch_size], key = lambda x: x['size'], reverse = True)
+    batches = []
+    for item in big:
+        batches.append(subset_of(files))
+        batches[-1].append(item)
+
+    batch = subset_of(files)
+    acc_size = 0
+    for item in files:
+        if item['size'] >= batch_size and not ordered:
+            continue
+
+        batch.append(item)
+        acc_size += item['size']
+
+        if len(batch) >= batch_files or acc_size >= batch_size:
+            batches.append(batch)
+            batch = subset_of(files)
+            acc_size = 0
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def error_record(operation, path, error):
+    """
+    Return the record of an error of a worker, sent back to the parent instead of printed from the worker
+
+    Parameters:
+        operation:  'open', 'read', 'size' when the size changed since the scan or 'hash' for anything unexpected
+        path:       Path of the file
+        error:      The exception, or the message for 'size'
+
+    Return:
+        dict:       {operation, path, errno, message}
+    """
+    return {'operation': operation, 'path': path, 'errno': getattr(error, 'errno', None),
+            'message': str(error) if isinstance(error, (str, OSError)) else f'{type(error).__name__}: {error}'}
+
+def format_error(record):
+    """Return the message of an error_record() as it is printed"""
+    if record['operation'] == 'open':
+        return f'Error opening file: {record["path"]} \n{record["message"]}'
+    if record['operation'] == 'read':
+        return f'Error reading data: {record["path"]} \n{record["message"]}'
+    if record['operation'] == 'size':
+        return f'{record["message"]}: {record["path"]}'
+    return f'Exception: {record["path"]} \n{record["message"]}'
+
+
+# Fields of each worker in a WorkerStatsBlock, 64 bit unsigned integers first and then doubles
+STATS_INT_FIELDS    = ('read_bytes', 'files', 'errors', 'read_calls')
+STATS_FLOAT_FIELDS  = ('busy_time', 'read_time', 'hash_time')
+STATS_SLOT_SIZE     = 8     # 8 byte fields per worker, a 64 byte cache line so workers don't share lines
+
+class WorkerStatsBlock():
+    """
+    Counters of a group of hashing workers in a single multiprocessing.shared_memory block
+
+    Each worker gets a slot of 64 bit fields that only it writes to, so there are no locks, and the parent reads
+    the whole block at once. Pass it to the workers and call unlink() once they are joined.
+    """
+
+    def __init__(self, slots, name = None):
+        """
+        Parameters:
+            slots:      Number of workers
+            name:       Name of an existing block to attach to, None to create one
+        """
+        self.slots = slots
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(slots, 1)*STATS_SLOT_SIZE*8)
+            self.shm.buf[:] = bytes(len(self.shm.buf))
+        else:
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                # Python < 3.13 registers the block again, the tracker of the worker would remove it when it exits
+                self.shm = shared_memory.SharedMemory(name=name)
+                if os.name == 'posix':
+                    from multiprocessing import resource_tracker
+                    resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+        self.ints   = self.shm.buf.cast('Q')
+        self.floats = self.shm.buf.cast('d')
+
+    def __getstate__(self):
+        return (self.shm.name, self.slots)
+
+    def __setstate__(self, state):
+        name, slots = state
+        self.__init__(slots, name)
+
+    def base(self, slot):
+        """Index of the first field of a slot in ints and floats"""
+        return slot*STATS_SLOT_SIZE
+
+    def read(self):
+        """
+        Read every slot in one pass
+
+        Return:
+            list:       [ {read_bytes, files, errors, read_calls, busy_time, read_time, hash_time}, ... ] by slot
+        """
+        ints = self.ints.tolist()
+        floats = self.floats.tolist()
+
+        values = []
+        for slot in range(self.slots):
+            base = self.base(slot)
+            entry = dict(zip(STATS_INT_FIELDS, ints[base: base + len(STATS_INT_FIELDS)]))
+            entry.update(zip(STATS_FLOAT_FIELDS, floats[base + len(STATS_INT_FIELDS): base + len(STATS_INT_FIELDS) + len(STATS_FLOAT_FIELDS)]))
+            values.append(entry)
+
+        return values
+
+    def total(self, field):
+        """Sum of an integer field over every slot"""
+        i = STATS_INT_FIELDS.index(field)
+        return sum(self.ints.tolist()[i: self.slots*STATS_SLOT_SIZE: STATS_SLOT_SIZE])
+
+    def close(self):
+        self.ints.release()
+        self.floats.release()
+        self.shm.close()
+
+    def unlink(self):
+        """Close and free the block, once every worker using it is joined"""
+        self.close()
+        self.shm.unlink()
+
 
 class QueuedFileHasher_mp(Process):
-    """Class for hashing a list of files in a separate process."""
+    """Class for hashing files in a separate process."""
 
-    def __init__(self, work_queue, work_queue_pos, algorithm = 'sha1', **kwargs):
+    def __init__(self, work_queue, stats, slot, algorithm = 'sha1', sample_size = 0, chunk_size = 1024*1024, mmap_min_size = 0, profile_dir = None, **kwargs):
         """
-        Hash a list of files asyncroniously in a separate process
+        Hash files asyncroniously in a separate process
 
-        Parameters:
-            work_queue:         A list of dictionaries like this [{path}, ...]
-            work_queue_pos:     An integer of type Value()
-            algorithm:          Any algorithm string supported by hashlib
+        Takes batches of files from a queue, that can be shared with other workers, and sends back each batch once
+        it is hashed. A None entry in the queue stops the worker. Errors are sent back with the results as
+        error_record() entries, the worker prints nothing.
 
+        Parameters:
+            work_queue:         A Queue() of batches made with pack_batch(). Each batch is sent back through the
+                                result_reader pipe as (batch_id, [(hex_digest, [error_record], new_size), ...]).
+                                Wait on result_reader with multiprocessing.connection.wait, it gets EOF if the
+                                worker dies
+            stats:              WorkerStatsBlock to write the counters of the worker to
+            slot:               Slot of the worker in stats
+            algorithm:          Any algorithm of algorithms_available()
+            sample_size:        If not 0 only hash the first and last sample_size bytes of the files bigger than
+                                2*sample_size instead of the whole content
+            chunk_size:         Size of the reads. Files are read into a single buffer of this size allocated once
+            mmap_min_size:      Files of at least this size are hashed from a memory map instead of read, 0 to disable
+            profile_dir:        Directory to write the cProfile stats of the worker to once it stops, <name>-<pid>.prof
+                                See write_profile_report
         """
-        assert(algorithm in hashlib.algorithms_available), f'hashlib doesnt support the "{algorithm}" algorithm'
+        assert(algorithm in algorithms_available()), f'the "{algorithm}" algorithm is not supported'
 
         super().__init__(target=self.worker, args=[], **kwargs)
 
         self.algorithm       = algorithm
+        self.sample_size     = sample_size
+        self.chunk_size      = chunk_size
+        self.mmap_min_size   = mmap_min_size
+        self.profile_dir     = profile_dir
         self.work_queue      = work_queue
-        self.work_queue_pos  = work_queue_pos
-        self.out_queue       = Queue()
-        self.read_bytes      = Value('i', 0)
+        self.stats           = stats
+        self.slot            = slot
         self.flag_run        = Value('i', 1)
 
+        # Only the worker writes to the pipe, closing the end of the parent lets it see EOF when the worker dies
+        self.result_reader, self.result_writer = Pipe(duplex=False)
+
         self.start()
+        self.result_writer.close()
 
 
     def stop(self):
@@ -48,97 +277,491 @@ class QueuedFileHasher_mp(Process):
         self.flag_run.value = 0
 
     def worker(self):
-        self.__hash_func = hashlib.new(self.algorithm)
+        self.result_reader.close()
+        try:
+            if not self.profile_dir:
+                return self.hash_loop()
+
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(self.hash_loop)
+            finally:
+                profiler.dump_stats(os.path.join(self.profile_dir, f'{self.name}-{os.getpid()}.prof'))
+        finally:
+            self.result_writer.close()
+
+    def hash_loop(self):
 
-        def read_to_hash(hash_func, file_obj, read_bytes, chunk):
-            data = file_obj.read(chunk)
-            hash_func.update(data)
-            read_bytes.value += len(data)
-            return len(data)
+        # Reads go into the same buffer for every file instead of allocating a bytes object per chunk
+        buffer = memoryview(bytearray(self.chunk_size))
+
+        # read time, hash time and read calls of the current file, added to the stats once per file
+        timings = [0.0, 0.0, 0]
+
+        # Slot of this worker in the stats block, only this process writes to it
+        ints, floats = self.stats.ints, self.stats.floats
+        base = self.stats.base(self.slot)
+        READ_BYTES, FILES, ERRORS, READ_CALLS = [base + i for i in range(len(STATS_INT_FIELDS))]
+        BUSY_TIME, READ_TIME, HASH_TIME = [base + len(STATS_INT_FIELDS) + i for i in range(len(STATS_FLOAT_FIELDS))]
+
+        def read_to_hash(hash_func, file_obj, length):
+            """Read up to length bytes into the hash, return the number of bytes read"""
+            done = 0
+            while done < length:
+                t0 = time.perf_counter()
+                n = file_obj.readinto(buffer[:min(self.chunk_size, length - done)])
+                t1 = time.perf_counter()
+                timings[0] += t1 - t0
+                timings[2] += 1
+                if not n: break
+                hash_func.update(buffer[:n])
+                timings[1] += time.perf_counter() - t1
+                ints[READ_BYTES] += n
+                done += n
+            return done
+
+        def mmap_to_hash(hash_func, file_obj):
+            """Hash the whole file from a memory map, return the number of bytes hashed"""
+            if os.fstat(file_obj.fileno()).st_size == 0:
+                return 0    # Can't map an empty file, it may have been truncated since the scan
+            with mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if hasattr(m, 'madvise'):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(m) as view:
+                    t0 = time.perf_counter()
+                    for i in range(0, len(view), self.chunk_size):
+                        chunk = view[i:i+self.chunk_size]
+                        hash_func.update(chunk)
+                        ints[READ_BYTES] += len(chunk)
+                        chunk.release()
+                    timings[1] += time.perf_counter() - t0
+                return len(m)
         
         output_buffer = []
+        batch = []
+        batch_id = None
+        batch_start = 0
 
         while self.flag_run.value:
             # Exit in case the parent pid is dead
             if not psutil.pid_exists(os.getppid()):
                 sys.exit(255)
 
-            error = {'error': []}
+            errors = []
             hex_digest = None
-            item = None
+            new_size = None
 
             # Try to get item
-            try:
-                if self.work_queue_pos.value < len(self.work_queue):
-                    item = self.work_queue[ self.work_queue_pos.value ]
-                    item.update({ 'proc_index': self.work_queue_pos.value })
-                    self.work_queue_pos.value += 1 
-                else:
+            if not batch:
+                # Send back the finished batch before waiting for the next one
+                if batch_id is not None:
+                    self.result_writer.send((batch_id, output_buffer))
+                    output_buffer = []
+                    batch_id = None
+                    floats[BUSY_TIME] += time.perf_counter() - batch_start
+
+                try:
+                    work = self.work_queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+
+                if work is None:
                     self.flag_run.value = 0
                     continue
-            except IndexError as e:
-                print(f'{e}\n len{len(self.work_queue)} - pos{self.work_queue_pos.value}')
-                raise
+                batch_id, batch = work
+                batch.reverse()
+                batch_start = time.perf_counter()
+
+            path, size = batch.pop()
 
             # Open file for reading
             fd = None
             try:
-                fd = item['path'].open('rb')
-            except (FileNotFoundError, PermissionError, OSError) as e:
-                msg = f'Error opening file: {str(item["path"])} \n{e}'
-                print(msg)
-                error['error'].append(msg)
+                fd = open(path, 'rb', buffering=0)
+            except OSError as e:
+                errors.append(error_record('open', path, e))
             except Exception as e:
-                print(f'Exception: {str(item["path"])} \n{e}')
-                raise
+                errors.append(error_record('hash', path, e))
 
             # read content and add it to the tally
-            prev_val = self.read_bytes.value
+            file_read = 0
             try:
-                hash_func = hashlib.new(self.algorithm)
-                if fd:
-                    while read_to_hash(hash_func, fd, self.read_bytes, 1024*1024): pass
+                hash_func = new_hasher(self.algorithm)
+                if fd and expected_read(size, self.sample_size) < size:
+                    # Head and tail sample
+                    file_read += read_to_hash(hash_func, fd, self.sample_size)
+                    fd.seek(size - self.sample_size)
+                    file_read += read_to_hash(hash_func, fd, self.sample_size)
 
                     hex_digest = hash_func.digest().hex().lower()
 
-            except (IOError, OSError) as e:
-                msg = f'Error reading data: {str(item["path"])} \n{e}'
-                print(msg)
-                error['error'].append(msg)
+                elif fd and self.mmap_min_size and size >= self.mmap_min_size:
+                    file_read += mmap_to_hash(hash_func, fd)
+
+                    hex_digest = hash_func.digest().hex().lower()
+
+                elif fd:
+                    while n := read_to_hash(hash_func, fd, self.chunk_size):
+                        file_read += n
+
+                    hex_digest = hash_func.digest().hex().lower()
+
+            except OSError as e:
+                errors.append(error_record('read', path, e))
 
             except Exception as e:
-                print(f'Exception: {str(item["path"])} \n{e}')
-                raise
-            
+                # Anything else goes back with the file too, a dead worker would lose the rest of its batch
+                errors.append(error_record('hash', path, e))
+                hex_digest = None
+
             # Close file
             if fd: fd.close()
 
             # Check file didnt change size in the inbetween
-            if self.read_bytes.value != prev_val + item['size']:
-                msg = f'File size changed from {item["size"]} to {self.read_bytes.value - prev_val}: {str(item["path"])}'
-                print(msg)
-                error['error'].append(msg)
-                item['oldsize'] = item['size']
-                item['size'] = item['path'].stat().st_size
-            
-
-            # Update item with the new values
-            if error['error'] and item:
-                item.update(error)
-            
-            # Update hash
-            if item:
-                item.update({
-                    'hash': hex_digest,
-                    'hash_algorithm': self.algorithm,
-                     })
-            
-            # add item to buffer
-            if item:
-                output_buffer.append(item)
+            if file_read != expected_read(size, self.sample_size):
+                errors.append(error_record('size', path, f'File size changed from {size} to {file_read}'))
+                try:
+                    new_size = os.stat(path).st_size
+                except OSError:
+                    new_size = 0
+
+            # add result to buffer, in the same order as the batch
+            output_buffer.append((hex_digest, errors, new_size))
+            ints[FILES] += 1
+            floats[READ_TIME] += timings[0]
+            floats[HASH_TIME] += timings[1]
+            ints[READ_CALLS] += timings[2]
+            if errors:
+                ints[ERRORS] += 1
+            timings[:] = [0.0, 0.0, 0]
         
         # Send items back
-        self.out_queue.put(output_buffer)
+        if batch_id is not None:
+            self.result_writer.send((batch_id, output_buffer))
+            floats[BUSY_TIME] += time.perf_counter() - batch_start
+
+
+def file_device(item):
+    """Return the st_dev of a {path, size, [dev]} item, 0 if it can't be read"""
+    if 'dev' not in item:
+        try:
+            item['dev'] = os.stat(item['path']).st_dev
+        except OSError:
+            return 0
+    return item['dev']
+
+def device_readers(dev, cpu_threads):
+    """Return the number of readers for a device, ROTATIONAL_READERS for spinning disks and cpu_threads otherwise"""
+    return ROTATIONAL_READERS if is_rotational(dev) else cpu_threads
+
+def device_pools(files, cpu_threads):
+    """
+    Group files by the device they are on
+
+    Files on a spinning disk are sorted by their position in the disk, so its few readers read them sequentially.
+
+    Parameters:
+        files:          List of {path, size, [dev, pos]} entries
+        cpu_threads:    Readers of the devices that aren't spinning disks
+
+    Return:
+        List:           [ {dev, rotational, readers, files}, ... ] the files of each device in a list, or FileRows for
+                        the rows of a FileTable
+    """
+    devices = {}
+    for item in files:
+        dev = file_device(item)
+        if dev not in devices:
+            devices[dev] = subset_of(files)
+        devices[dev].append(item)
+
+    pools = []
+    for dev, items in devices.items():
+        rotational = bool(is_rotational(dev))
+        if rotational:
+            # Sorted by position alone, files at the same position keep their order. Run_phases passes them
+            # sorted by (pos, path) already and a key with the paths would hold a string for each file.
+            items.sort(key = lambda x: x['pos'] if 'pos' in x else 0)
+
+        pools.append({'dev': dev, 'rotational': rotational, 'readers': device_readers(dev, cpu_threads), 'files': items})
+
+    return pools
+
+def get_worker_stats(name, device, values, wall_time):
+    """
+    Return the stats of a QueuedFileHasher_mp
+
+    Parameters:
+        name:       Name of the worker
+        device:     st_dev of the files it read
+        values:     Its slot of WorkerStatsBlock.read()
+        wall_time:  Seconds since the hashing started, utilisation is the fraction of it the worker was busy
+
+    Return:
+        dict:       {name, device, files, read_size, busy_time, utilisation, read_time, hash_time, read_calls, errors}
+    """
+    return {
+        'name':         name,
+        'device':       device,
+        'files':        values['files'],
+        'read_size':    values['read_bytes'],
+        'busy_time':    values['busy_time'],
+        'utilisation':  values['busy_time'] / wall_time if wall_time else 0.0,
+        'read_time':    values['read_time'],
+        'hash_time':    values['hash_time'],
+        'read_calls':   values['read_calls'],
+        'errors':       values['errors'],
+        }
+
+def pack_batch(batch_id, items):
+    """Return the work entry of a batch for QueuedFileHasher_mp: (batch_id, [(path, size), ...])"""
+    return (batch_id, [(str(item['path']), item['size']) for item in items])
+
+def feed_queue(pool, batches):
+    """
+    Queue the batches of a device pool while its queue has room, and after the last one a None for each worker
+
+    Parameters:
+        pool:       {queue, batch_ids, next, stops} from hash_files. next and stops count what was already queued
+        batches:    All the batches, by id
+    """
+    while not pool['queue'].full():
+        if pool['next'] < len(pool['batch_ids']):
+            batch_id = pool['batch_ids'][pool['next']]
+            pool['queue'].put(pack_batch(batch_id, batches[batch_id]))
+            pool['next'] += 1
+        elif pool['stops']:
+            pool['queue'].put(None)
+            pool['stops'] -= 1
+        else:
+            break
+
+def apply_results(items, results, algorithm):
+    """
+    Update the items of a batch with the results sent back by QueuedFileHasher_mp
+
+    Parameters:
+        items:      The {path, size} items of the batch, in the order they were packed
+        results:    [(hex_digest, [error_record], new_size), ...]. The errors are printed and kept in the 'error'
+                    of the item as messages
+        algorithm:  Algorithm the batch was hashed with
+    """
+    for item, (hex_digest, errors, new_size) in zip(items, results):
+        if errors:
+            item['error'] = [format_error(record) for record in errors]
+            for msg in item['error']:
+                print(msg)
+        if new_size is not None:
+            item['oldsize'] = item['size']
+            item['size'] = new_size
+
+        item.update({
+            'hash': hex_digest,
+            'hash_algorithm': algorithm,
+            })
+
+def lost_results(items):
+    """Return the results of a batch that never came back because its worker died, an error for each item. See apply_results"""
+    return [(None, [error_record('hash', str(item['path']), 'the hashing process exited before sending it back')], None) for item in items]
+
+def receive(workers, timeout):
+    """
+    Wait for batches sent back by QueuedFileHasher_mp workers
+
+    Parameters:
+        workers:    Workers to wait on, the ones that died are removed from it
+        timeout:    Seconds to wait for the first batch, 0 to only take the ones already there
+
+    Return:
+        List:       [ (worker, batch_id, results), ... ] every batch available once the first one arrived
+    """
+    batches = []
+    readers = {worker.result_reader: worker for worker in workers}
+    if not readers:
+        time.sleep(timeout)
+        return batches
+
+    ready = wait(list(readers), timeout)
+    while ready:
+        for reader in ready:
+            try:
+                batch_id, results = reader.recv()
+            except EOFError:
+                # The worker is gone, its end of the pipe got closed
+                worker = readers[reader]
+                worker.join()
+                if worker.exitcode:
+                    print(f'Hashing process {worker.name} exited with code {worker.exitcode}')
+                workers.remove(worker)
+                del readers[reader]
+                continue
+            batches.append((readers[reader], batch_id, results))
+        ready = wait(list(readers), 0) if readers else []
+
+    return batches
+
+
+class HashStream():
+    """
+    Hash files as they are submitted with pools of QueuedFileHasher_mp fed from bounded queues.
+
+    Each device gets its own pool the first time one of its files is submitted, with device_readers() processes
+    and a WorkerStatsBlock for their counters. submit() splits the items in batches with make_batches() and blocks
+    while the queue of a device is full, so a fast producer is throttled by the hashers instead of piling up work
+    in memory. The hashed items come back in batches through results().
+    """
+
+    def __init__(self, cpu_threads, algorithm = 'sha1', queue_size = None, **read_options):
+        """
+        Parameters:
+            cpu_threads:    Number of hashing processes of each device that isn't a spinning disk
+            algorithm:      Any algorithm of algorithms_available()
+            queue_size:     Maximum number of batches waiting to be hashed on each device. Defaults to 4 per process.
+            read_options:   chunk_size, mmap_min_size and profile_dir of QueuedFileHasher_mp
+        """
+        self.cpu_threads  = cpu_threads
+        self.algorithm    = algorithm
+        self.queue_size   = queue_size
+        self.read_options = read_options
+        self.pools      = {}    # dev: {queue, workers, stats}
+        self.workers    = []
+        self.running    = []    # workers that didn't exit yet
+        self.batches    = {}    # batches being hashed by id
+        self.hashed     = []    # items received while submit() waited
+        self.next_id    = 0
+        self.submitted  = 0
+        self.received   = 0
+        self.closed     = False
+        self.start_time = time.perf_counter()
+        self.final_stats = None     # stats of the workers once they are joined and the blocks freed
+
+    def pool(self, dev):
+        """Return the {queue, workers, stats} pool of a device, starting it if needed"""
+        if dev not in self.pools:
+            readers = device_readers(dev, self.cpu_threads)
+            work_queue = Queue(maxsize = self.queue_size or readers*4)
+            stats = WorkerStatsBlock(readers)
+            workers = [QueuedFileHasher_mp(work_queue, stats, i, algorithm=self.algorithm, name=f'proc-{len(self.workers) + i}', **self.read_options)
+                       for i in range(readers)]
+            self.workers.extend(workers)
+            self.running.extend(workers)
+            self.pools[dev] = {'queue': work_queue, 'workers': workers, 'stats': stats}
+
+        return self.pools[dev]
+
+    @property
+    def pending(self):
+        """Number of submitted items that didn't come back yet"""
+        return self.submitted - self.received
+
+    @property
+    def read_bytes(self):
+        """Total number of bytes read by the workers"""
+        if self.final_stats is not None:
+            return sum([worker['read_size'] for worker in self.final_stats])
+        return sum([pool['stats'].total('read_bytes') for pool in self.pools.values()])
+
+    def submit(self, batch):
+        """Queue a list of {path, size} items for hashing"""
+        devices = {}
+        for item in batch:
+            devices.setdefault(file_device(item), []).append(item)
+
+        for dev, items in devices.items():
+            pool = self.pool(dev)
+            for part in make_batches(items, len(pool['workers']), ordered = True):
+                work = pack_batch(self.next_id, part)
+                self.batches[self.next_id] = part
+                self.next_id += 1
+                self.submitted += len(part)
+
+                # The workers block on a full pipe, keep taking their results while the queue is full
+                while True:
+                    try:
+                        pool['queue'].put(work, timeout = 0.1)
+                        break
+                    except queue.Full:
+                        self.collect(0)
+
+    def collect(self, timeout):
+        """Take the batches the workers sent back, see receive(), and keep their items for results()"""
+        for worker, batch_id, results in receive(self.running, timeout):
+            batch = self.batches.pop(batch_id)
+            apply_results(batch, results, self.algorithm)
+            self.hashed.extend(batch)
+            self.received += len(batch)
+
+        # Every worker exited, what is left won't come back
+        if not self.running and self.batches:
+            for batch_id, batch in self.batches.items():
+                apply_results(batch, lost_results(batch), self.algorithm)
+                self.hashed.extend(batch)
+                self.received += len(batch)
+            self.batches = {}
+
+    def results(self, timeout = 0):
+        """
+        Return the hashed items available
+
+        Parameters:
+            timeout:    Seconds to wait for a batch if there is none yet, 0 to only take the ones already there
+
+        Return:
+            List:      [ {hash, path, size}, ... ]
+        """
+        if not self.hashed:
+            self.collect(timeout if self.pending else 0)
+
+        output, self.hashed = self.hashed, []
+        return output
+
+    def connections(self):
+        """Return the pipes of the running workers, to wait on them along other sources. See results()"""
+        return [worker.result_reader for worker in self.running]
+
+    def close(self):
+        """Tell the workers there is no more work. results() should be drained after and then join() called."""
+        if not self.closed:
+            for pool in self.pools.values():
+                for worker in pool['workers']:
+                    pool['queue'].put(None)
+            self.closed = True
+
+    def join(self):
+        """Stop and join the workers, and free their stats blocks"""
+        self.close()
+        for worker in self.workers:
+            worker.join()
+
+        if self.final_stats is None:
+            self.final_stats = self.worker_stats()
+            for pool in self.pools.values():
+                pool['stats'].unlink()
+
+    def stop(self, timeout = 5):
+        """Stop the workers without waiting for the queued work, and free their stats blocks"""
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+
+        self.closed = True
+        self.join()
+
+    def worker_stats(self):
+        """Return the stats of each worker, see get_worker_stats"""
+        if self.final_stats is not None:
+            return self.final_stats
+
+        wall_time = time.perf_counter() - self.start_time
+        stats = []
+        for dev, pool in self.pools.items():
+            values = pool['stats'].read()
+            stats += [get_worker_stats(worker.name, dev, values[worker.slot], wall_time) for worker in pool['workers']]
+        return stats
 
 
 class AsyncSpawner(Thread):
@@ -149,34 +772,49 @@ class AsyncSpawner(Thread):
     The worker process can be retrieves on AsyncSpawner.worker
     """
 
-    def __init__(self, files, common_queue_pos, algorithm, name):
-        super().__init__(target=self.spawner, args=[files, common_queue_pos, algorithm, name])
+    def __init__(self, work_queue, stats, slot, algorithm, name, sample_size = 0, read_options = {}):
+        super().__init__(target=self.spawner, args=[work_queue, stats, slot, algorithm, name, sample_size, read_options])
 
         self.done = False
         self.worker = None
 
         self.start()
 
-    def spawner(self, work_queue, work_queue_pos, algorithm, name):
+    def spawner(self, work_queue, stats, slot, algorithm, name, sample_size, read_options):
         self.worker = QueuedFileHasher_mp(
             work_queue,
-            work_queue_pos, 
+            stats,
+            slot,
             algorithm=algorithm, 
+            sample_size=sample_size,
+            **read_options,
             name=name
             )
 
         self.done = True
 
 
-def hash_files(files, cpu_threads, algorithm = 'sha1'):
+def hash_files(files, cpu_threads, algorithm = 'sha1', sample_size = 0, cache = None, worker_stats = None, **read_options):
     """
     Create a list with all the hashes corresponding to the files.
 
+    The files are grouped by device with device_pools() and each device gets its own queue and workers, one
+    reading in disk position order for a spinning disk and cpu_threads for the rest. The files of a device are
+    split with make_batches() in its queue, so a worker that gets a few big files doesn't hold the rest while
+    the others sit idle. The queues are bounded like the ones of HashStream and get topped up as the batches
+    come back, only a few batches at a time wait packed in them.
+
     Parameters:
         files:      List of {path, size} entries
+        cpu_threads: Workers of each device that isn't a spinning disk
+        sample_size: If not 0 only the head and tail samples of this size get hashed. See QueuedFileHasher_mp
+        cache:      HashCache to look up the digests in before reading the files. New digests get stored in it.
+        worker_stats: If a list is given it gets filled with the {name, device, files, read_size, busy_time, utilisation,
+                    read_time, hash_time, read_calls, errors} of each worker. See get_worker_stats
+        read_options: chunk_size, mmap_min_size and profile_dir of QueuedFileHasher_mp
 
     Return:
-        List:      [ {hash, path, size}, ... ]
+        List:      [ {hash, path, size}, ... ] FileRows for the rows of a FileTable
     """
     # Rate limiter for writing progress to console
     rate_limiter = timed_tigger(10)
@@ -184,12 +822,34 @@ def hash_files(files, cpu_threads, algorithm = 'sha1'):
     # accumulated data read
     acc_size = 0     
 
+    # Files with a valid cached digest don't get queued
+    cached = []
+    cache_tag = algorithm if not sample_size else f'{algorithm}/sample{sample_size}'
+    if cache is not None:
+        files, cached = cache.lookup(files, cache_tag)
+
     # total data to read
-    total_size = sum( [item['size'] for item in files] )   
+    total_size = sum( expected_read(item['size'], sample_size) for item in files )   
     
-    # Split the list for each thread in a smart way to avoid spawning 12 processes for 12 items
-    splits = split_list(files, cpu_threads, 25)
-    cpu_threads = min(cpu_threads, len(splits))
+    # A work queue per device, avoid spawning 12 processes for 12 items
+    pools = device_pools(files, cpu_threads)
+    batches = []
+    for pool in pools:
+        pool_batches = make_batches(pool['files'], pool['readers'], ordered = pool['rotational'])
+        pool['readers'] = min(pool['readers'], len(pool_batches))
+        del pool['files']
+
+        pool['queue'] = Queue(maxsize = pool['readers']*4)
+        pool.update({'batch_ids': range(len(batches), len(batches) + len(pool_batches)), 'next': 0, 'stops': pool['readers']})
+        batches.extend(pool_batches)
+        feed_queue(pool, batches)
+
+    # Workers in spawn order, one of each device first so none of them waits for the others
+    spawn_order = [pool for i in range(max([0] + [pool['readers'] for pool in pools])) for pool in pools if i < pool['readers']]
+    cpu_threads = len(spawn_order)
+
+    # One slot of counters for each worker, in spawn order
+    stats = WorkerStatsBlock(cpu_threads)
 
     # Progress bar class
     pb = MultiProgressBar(_max = [total_size, cpu_threads], _min = 0, nbars = 2, update_rate = (1/20), lenght = 35, ignore_over_under= True, charset = "#-", autostart = True)
@@ -198,63 +858,221 @@ def hash_files(files, cpu_threads, algorithm = 'sha1'):
     pb.set_endtext(" Hashing files...")
     pb.bars_indicator = 0
 
+    start_time = time.perf_counter()
     process_pool = []
-    output = []
+    running = []        # workers that didn't exit yet
+    received = set()    # ids of the batches sent back
+    output = subset_of(files)
     while len(output) < len(files):
         # Loop until we get back all the jobs
+        for pool in pools:
+            feed_queue(pool, batches)
 
         # Spawn the worker processes
         if len(process_pool) < cpu_threads:
-            counter = Value('i', 0)
-            process_pool.append({'spawner': AsyncSpawner(splits[len(process_pool)], counter, algorithm='sha1', name=f'proc-{len(process_pool)}'),
-                                 'position': counter})
+            pool = spawn_order[len(process_pool)]
+            process_pool.append({'device': pool['dev'],
+                                 'spawner': AsyncSpawner(pool['queue'], stats, len(process_pool), algorithm=algorithm, name=f'proc-{len(process_pool)}',
+                                                         sample_size=sample_size, read_options=read_options)})
             pb.set(1, len(process_pool))
         
         # Check if the spawner finished and add a key for the worker if so
-        for i, proc in enumerate(process_pool):
-            if 'worker' in proc:
-                try:
-                    tmp = proc['worker'].out_queue.get(timeout=0.1)
-                    output.extend(tmp)
-                except queue.Empty as e:
-                    pass
-            else:
-                if proc['spawner'].done:
-                    proc['worker'] = proc['spawner'].worker
-                    proc['spawner'].join()
-                    del(proc['spawner'])
-            
-        
+        for proc in process_pool:
+            if 'spawner' in proc and proc['spawner'].done:
+                proc['worker'] = proc['spawner'].worker
+                proc['spawner'].join()
+                del(proc['spawner'])
+                running.append(proc['worker'])
+
+        # Wait for the first worker to send a batch back, once every worker is on its way
+        for worker, batch_id, results in receive(running, 0.1 if len(process_pool) == cpu_threads else 0):
+            apply_results(batches[batch_id], results, algorithm)
+            output.extend(batches[batch_id])
+            received.add(batch_id)
+
+        # Every worker exited, the batches that didn't come back were lost with a worker that died
+        if not running and all(['worker' in proc for proc in process_pool]) and len(process_pool) == cpu_threads:
+            for batch_id, batch in enumerate(batches):
+                if batch_id not in received:
+                    apply_results(batch, lost_results(batch), algorithm)
+                    output.extend(batch)
+            break
+
         if rate_limiter.triggered():
             # Update progress bar
-            acc_size = 0
-
-            for proc in process_pool:
-                try:
-                    acc_size += proc['worker'].read_bytes.value
-                except:
-                    pass
+            acc_size = stats.total('read_bytes')
 
             pb.set(0,acc_size)
+
+    wall_time = time.perf_counter() - start_time
+
+    # The workers exit as soon as they get their None, instead of waiting for the stop flag
+    for pool in pools:
+        feed_queue(pool, batches)
     
     # Set the progress bar to max
     pb.set(0, total_size)
     pb.set_endtext(" Finishing tasks")
     
+    # Workers still being spawned when the work ran out
+    for proc in process_pool:
+        if 'spawner' in proc:
+            proc['spawner'].join()
+            proc['worker'] = proc['spawner'].worker
 
     # Stop all workers and join them
     for process in process_pool:
         process['worker'].stop()
     
-    while len(process_pool):
-        process_pool[0]['worker'].join()
-        del( process_pool[0] )
+    for process in process_pool:
+        process['worker'].join()
+
+    if worker_stats is not None:
+        values = stats.read()
+        for process in process_pool:
+            worker_stats.append(get_worker_stats(process['worker'].name, process['device'], values[process['worker'].slot], wall_time))
+
+    process_pool = []
+    stats.unlink()
     
     # Stop progress bar
     pb.set_endtext(" Done")
     pb.stop(True); del pb    
+
+    if cache is not None:
+        cache.store(output, cache_tag)
+    output.extend(cached)
     
     return output
 
 
+def confirm_collisions(files, cpu_threads, algorithm, cache = None, worker_stats = None, **read_options):
+    """
+    Rehash with a cryptographic algorithm the files that share their (size, hash) with another file.
+
+    Used after hashing with one of FAST_ALGORITHMS, the other files are different from every other one and
+    keep their fast digest. Empty files are left as they are.
+
+    Parameters:
+        files:          List of hashed {path, size, hash} entries, they get updated in place
+        algorithm:      Algorithm to confirm the collisions with
+        cache:          HashCache passed to hash_files
+        worker_stats:   List filled by hash_files with the stats of each worker
+
+    Return:
+        list:           The entries that got rehashed, FileRows for the rows of a FileTable
+    """
+    # Count the files of each (size, hash) first, so only the colliding ones get picked out
+    groups = {}
+    for item in files:
+        if item.get('hash') is not None and item['size'] > 0:
+            key = (item['size'], item['hash'])
+            groups[key] = groups.get(key, 0) + 1
+
+    colliding = subset_of(files)
+    for item in files:
+        if item.get('hash') is not None and item['size'] > 0 and groups[(item['size'], item['hash'])] > 1:
+            colliding.append(item)
+    del groups
+
+    if colliding:
+        hash_files(colliding, cpu_threads, algorithm, cache=cache, worker_stats=worker_stats, **read_options)
+
+    return colliding
+
+def hash_files_staged(files, cpu_threads, algorithm = 'sha1', sample_size = 4096, cache = None, confirm_algorithm = None, **read_options):
+    """
+    Hash the files in stages, only reading the whole content of the files that are still colliding.
+
+    First a head and tail sample of each file gets hashed, files whose (size, sample hash) is unique are dropped
+    and the rest gets the full digest. Files up to 2*sample_size go straight to the full digest.
+    With a confirm_algorithm, the files whose full digest still collides get hashed again with it and the
+    rest is dropped.
+
+    Parameters:
+        files:              List of {path, size} entries. Should only contain files sharing their size with other ones.
+        sample_size:        Size of the head and tail samples
+        cache:              HashCache passed to hash_files
+        confirm_algorithm:  Cryptographic algorithm to confirm the collisions of a fast algorithm, or None
+        read_options:   chunk_size, mmap_min_size and profile_dir of QueuedFileHasher_mp
+
+    Return:
+        tuple:          ( [ {hash, path, size}, ... ], {stage: {files, cached_files, dropped_files, read_size, avoided_size, workers}} )
+                        workers is the worker_stats list of hash_files
+                        The list only contains the files that made it to the last stage, FileRows for the rows of a FileTable.
+    """
+    stats = {
+        'sample':   {'files': 0, 'cached_files': 0, 'dropped_files': 0, 'read_size': 0, 'avoided_size': 0, 'workers': []},
+        'full':     {'files': 0, 'cached_files': 0, 'dropped_files': 0, 'read_size': 0, 'avoided_size': 0, 'workers': []},
+        'confirm':  {'files': 0, 'cached_files': 0, 'dropped_files': 0, 'read_size': 0, 'avoided_size': 0, 'workers': []},
+        }
+
+    small = subset_of(files)
+    large = subset_of(files)
+    for item in files:
+        if expected_read(item['size'], sample_size) == item['size']:
+            small.append(item)
+        else:
+            large.append(item)
+
+    # ---- Stage 1: head and tail samples ----
+    sampled = hash_files(large, cpu_threads, algorithm, sample_size, cache, stats['sample']['workers'], **read_options) if large else []; print()
+    del large
+
+    # Count the files of each (size, sample hash), then pick out the ones sharing it
+    groups = {}
+    for item in sampled:
+        key = (item['size'], item['hash'])
+        groups[key] = groups.get(key, 0) + 1
+
+    survivors = subset_of(files)
+    for item in sampled:
+        if item['hash'] is None or groups[(item['size'], item['hash'])] < 2:
+            # Unreadable or different from every other sample
+            item.pop('hash', None)
+            item.pop('hash_algorithm', None)
+            stats['sample']['dropped_files'] += 1
+            stats['sample']['avoided_size'] += item['size'] - expected_read(item['size'], sample_size)
+        else:
+            survivors.append(item)
+    del groups
+
+    stats['sample']['files'] = len(sampled)
+    stats['sample']['cached_files'] = sum(1 for item in sampled if item.get('cached'))
+    stats['sample']['read_size'] = sum(expected_read(item['size'], sample_size) for item in sampled if not item.get('cached'))
+
+    # ---- Stage 2: full digest ----
+    to_hash = small + survivors
+    del small, survivors
+    output = hash_files(to_hash, cpu_threads, algorithm, cache=cache, worker_stats=stats['full']['workers'], **read_options) if to_hash else subset_of(files)
+    del to_hash
+
+    stats['full']['files'] = len(output)
+    stats['full']['cached_files'] = sum(1 for item in output if item.get('cached'))
+    stats['full']['read_size'] = sum(item['size'] for item in output if not item.get('cached'))
+
+    # ---- Stage 3: confirm the collisions of a fast algorithm ----
+    if confirm_algorithm:
+        confirmed = confirm_collisions(output, cpu_threads, confirm_algorithm, cache, stats['confirm']['workers'], **read_options)
+
+        # The rehashed files got the confirm algorithm, the rest were different from every other one. The views
+        # of FileRows are made on the fly, so they are told apart by their algorithm and not by their id.
+        kept = subset_of(output)
+        for item in output:
+            if item.get('hash_algorithm') == confirm_algorithm:
+                kept.append(item)
+            else:
+                item.pop('hash', None)
+                item.pop('hash_algorithm', None)
+                stats['confirm']['dropped_files'] += 1
+
+        output = kept
+
+        stats['confirm']['files'] = len(confirmed)
+        stats['confirm']['cached_files'] = sum(1 for item in confirmed if item.get('cached'))
+        stats['confirm']['read_size'] = sum(item['size'] for item in confirmed if not item.get('cached'))
+
+    return output, stats
+
+
             
\ No newline at end of file
@@ -0,0 +1,360 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+
+from array import array
+from pathlib import Path
+
+
+class FileRecord():
+    """
+    View of a row of a FileTable that behaves like the {path, size, ...} dictionaries used everywhere else.
+
+    It doesn't hold any data, reading or updating a key reads or updates the table. Keys that aren't
+    columns of the table (error, oldsize, ...) are kept in a per row dictionary of the table.
+    """
+
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, key):
+        return self.table.get_value(self.row, key)
+
+    def __setitem__(self, key, value):
+        self.table.set_value(self.row, key, value)
+
+    def __contains__(self, key):
+        return self.table.has_value(self.row, key)
+
+    def get(self, key, default = None):
+        return self[key] if key in self else default
+
+    def update(self, values):
+        for key, value in values.items():
+            self.table.set_value(self.row, key, value)
+
+    def pop(self, key, *default):
+        return self.table.pop_value(self.row, key, *default)
+
+    def keys(self):
+        return [key for key in self.table.KEYS if key in self] + list(self.table.extra.get(self.row, {}).keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __repr__(self):
+        return f'FileRecord({ {key: self[key] for key in self.keys()} })'
+
+
+class FileRows():
+    """
+    Subset of the rows of a FileTable, kept as an array of row numbers.
+
+    It behaves like a list of FileRecord views, but the views are only created while iterating it. Passing
+    the files between phases costs a few bytes per file instead of a view object per file. The row numbers
+    are only valid until the table gets sorted.
+    """
+
+    __slots__ = ('table', 'rows')
+
+    def __init__(self, table, rows = None):
+        self.table = table
+        self.rows = array('L') if rows is None else rows
+
+    def append(self, item):
+        """Add a FileRecord of the table"""
+        self.rows.append(item.row)
+
+    def extend(self, items):
+        """Add the rows of another subset of the table or a list of its FileRecords"""
+        if isinstance(items, FileRows):
+            self.rows.extend(items.rows)
+        else:
+            for item in items:
+                self.rows.append(item.row)
+
+    def subset(self):
+        """Return an empty subset of the same table"""
+        return FileRows(self.table)
+
+    def sort(self, key = None, reverse = False):
+        """Sort in place by key(FileRecord), or in the order of the table without a key"""
+        if key is None:
+            self.rows = array(self.rows.typecode, sorted(self.rows, reverse = reverse))
+        else:
+            table = self.table
+            self.rows = array(self.rows.typecode, sorted(self.rows, key = lambda row: key(FileRecord(table, row)), reverse = reverse))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        return FileRecord(self.table, self.rows[i])
+
+    def __iter__(self):
+        table = self.table
+        for row in self.rows:
+            yield FileRecord(table, row)
+
+    def __add__(self, other):
+        output = FileRows(self.table, array(self.rows.typecode, self.rows))
+        output.extend(other)
+        return output
+
+
+def subset_of(files):
+    """Return an empty list for the files picked out of files, a FileRows if they are the rows of a FileTable"""
+    if isinstance(files, (FileTable, FileRows)):
+        return files.subset()
+    return []
+
+
+class FileTable():
+    """
+    Compact column store of scanned files.
+
+    Numbers are kept in typed arrays, digests in a single fixed width buffer, directory names are interned
+    and file names are packed in a single bytes buffer. A row takes around a hundred bytes plus the length
+    of its name, instead of a dictionary and a Path object per file.
+
+    Rows are accessed through FileRecord views, so a FileTable can be used where a list of {path, size, ...}
+    dictionaries is expected.
+    """
+
+    # Integer columns and their array type
+    COLUMNS = {'size': 'q', 'pos': 'q', 'dev': 'Q', 'ino': 'Q', 'mtime_ns': 'q', 'nlink': 'L', 'symlink': 'B', 'mode': 'H'}
+    KEYS    = ('path', *COLUMNS.keys(), 'hash', 'hash_algorithm')
+
+    def __init__(self, digest_size = 20):
+        """
+        Parameters:
+            digest_size:    Width in bytes of the digests, it grows if a longer digest is stored
+        """
+        self.columns        = { name: array(typecode) for name, typecode in self.COLUMNS.items() }
+        self.dir_index      = array('L')
+        self.dirs           = []
+        self.dirs_lookup    = {}
+        self.names          = bytearray()
+        self.names_offset   = array('Q')
+        self.names_end      = array('Q')
+        self.digest_size    = digest_size
+        self.digests        = bytearray()
+        self.digest_len     = array('B')  # 0 means no digest in the buffer
+        self.algorithm      = array('B')  # index in self.algorithms + 1, 0 means no algorithm
+        self.algorithms     = []
+        self.extra          = {}
+
+    # ---- Rows ------------------------------------------------------------------
+
+    def append(self, path, size = 0, dev = 0, ino = 0, mtime_ns = 0, pos = 0, nlink = 0, symlink = False, mode = 0):
+        """Add a file and return its FileRecord"""
+        directory, name = os.path.split(str(path))
+
+        index = self.dirs_lookup.get(directory)
+        if index is None:
+            index = len(self.dirs)
+            self.dirs.append(directory)
+            self.dirs_lookup[directory] = index
+
+        name = os.fsencode(name)
+        self.dir_index.append(index)
+        self.names_offset.append(len(self.names))
+        self.names.extend(name)
+        self.names_end.append(len(self.names))
+
+        for column, value in zip(('size', 'pos', 'dev', 'ino', 'mtime_ns', 'nlink', 'symlink', 'mode'), (size, pos, dev, ino, mtime_ns, nlink, symlink, mode)):
+            self.columns[column].append(value)
+
+        self.digests.extend(bytes(self.digest_size))
+        self.digest_len.append(0)
+        self.algorithm.append(0)
+
+        return FileRecord(self, len(self.dir_index) - 1)
+
+    def add(self, item):
+        """Add a {path, size, ...} dictionary and return its FileRecord"""
+        record = self.append(item['path'])
+        record.update({ k: v for k, v in item.items() if k != 'path' })
+        return record
+
+    def extend(self, items):
+        """Add the rows of another FileTable or a list of dictionaries"""
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return len(self.dir_index)
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError('FileTable index out of range')
+        return FileRecord(self, row)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield FileRecord(self, row)
+
+    def subset(self):
+        """Return an empty FileRows of the table"""
+        return FileRows(self)
+
+    def sort(self, *columns):
+        """
+        Reorder the rows in place by the given columns, 'path' compares the path strings
+
+        The rows are sorted by the first column alone, only the rows that tie on it get the other keys built.
+
+        Parameters:
+            columns:    Names of the columns, for example sort('pos', 'path')
+        """
+        keys = []
+        for column in columns:
+            if column == 'path':
+                keys.append(self.path_str)
+            else:
+                keys.append(self.columns[column].__getitem__)
+
+        first, rest = keys[0], keys[1:]
+        order = array('L', sorted(range(len(self)), key = first))
+
+        if rest:
+            key = rest[0] if len(rest) == 1 else (lambda row: tuple(k(row) for k in rest))
+            start = 0
+            for end in range(1, len(order) + 1):
+                if end < len(order) and first(order[end]) == first(order[start]):
+                    continue
+                if end - start > 1:
+                    order[start:end] = array('L', sorted(order[start:end], key = key))
+                start = end
+
+        self.reorder(order)
+
+    def reorder(self, order):
+        """Reorder the rows in place. order is the list of the old row indexes in the new order"""
+        for name, column in self.columns.items():
+            self.columns[name] = array(column.typecode, map(column.__getitem__, order))
+
+        names = bytearray()
+        names_offset = array('Q')
+        names_end = array('Q')
+        for row in order:
+            names_offset.append(len(names))
+            names.extend(self.names[self.names_offset[row]:self.names_end[row]])
+            names_end.append(len(names))
+        self.names, self.names_offset, self.names_end = names, names_offset, names_end
+
+        w = self.digest_size
+        digests = bytearray(len(order)*w)
+        source = memoryview(self.digests)
+        for new, row in enumerate(order):
+            digests[new*w:(new+1)*w] = source[row*w:(row+1)*w]
+        source.release()
+        self.digests    = digests
+        self.dir_index  = array(self.dir_index.typecode, map(self.dir_index.__getitem__, order))
+        self.digest_len = array(self.digest_len.typecode, map(self.digest_len.__getitem__, order))
+        self.algorithm  = array(self.algorithm.typecode, map(self.algorithm.__getitem__, order))
+
+        new_row = { old: new for new, old in enumerate(order) if old in self.extra }
+        self.extra = { new_row[old]: values for old, values in self.extra.items() }
+
+    # ---- Values ----------------------------------------------------------------
+
+    def path_str(self, row):
+        """Return the path of a row as a string"""
+        return os.path.join(self.dirs[self.dir_index[row]], os.fsdecode(bytes(self.names[self.names_offset[row]:self.names_end[row]])))
+
+    def digest(self, row):
+        """Return the raw digest of a row or None"""
+        length = self.digest_len[row]
+        if not length:
+            return None
+        return bytes(self.digests[(row+1)*self.digest_size - length:(row+1)*self.digest_size])
+
+    def get_value(self, row, key):
+        if key == 'path':
+            return Path(self.path_str(row))
+        if key in self.columns:
+            return self.columns[key][row]
+        if key == 'hash' and self.digest_len[row]:
+            return self.digest(row).hex()
+        if key == 'hash_algorithm' and self.algorithm[row]:
+            return self.algorithms[self.algorithm[row] - 1]
+        return self.extra[row][key]
+
+    def has_value(self, row, key):
+        if key == 'path' or key in self.columns:
+            return True
+        if key == 'hash' and self.digest_len[row]:
+            return True
+        if key == 'hash_algorithm' and self.algorithm[row]:
+            return True
+        return key in self.extra.get(row, {})
+
+    def set_value(self, row, key, value):
+        if key == 'path':
+            raise KeyError('The path of a FileTable row can not be changed')
+
+        elif key in self.columns:
+            self.columns[key][row] = value
+
+        elif key == 'hash' and self._fixed_width(value):
+            digest = bytes.fromhex(value)
+            if len(digest) > self.digest_size:
+                self._widen(len(digest))
+            w = self.digest_size
+            self.digests[row*w:(row+1)*w] = digest.rjust(w, b'\0')
+            self.digest_len[row] = len(digest)
+            if 'hash' in self.extra.get(row, {}):
+                self.pop_value(row, 'hash')
+
+        elif key == 'hash_algorithm':
+            if value not in self.algorithms:
+                self.algorithms.append(value)
+            self.algorithm[row] = self.algorithms.index(value) + 1
+
+        else:
+            # Digests that don't fit the buffer (None after an error, ids, ...) are kept as they are
+            if key == 'hash':
+                self.digest_len[row] = 0
+            self.extra.setdefault(row, {})[key] = value
+
+    def pop_value(self, row, key, *default):
+        if row in self.extra and key in self.extra[row]:
+            value = self.extra[row].pop(key)
+            if not self.extra[row]:
+                del self.extra[row]
+            return value
+        if key == 'hash' and self.digest_len[row]:
+            value = self.digest(row).hex()
+            self.digest_len[row] = 0
+            return value
+        if key == 'hash_algorithm' and self.algorithm[row]:
+            value = self.algorithms[self.algorithm[row] - 1]
+            self.algorithm[row] = 0
+            return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def _fixed_width(self, value):
+        """Whether a hash value is an hex digest that can be stored in the buffer"""
+        if not isinstance(value, str) or not value or len(value) % 2:
+            return False
+        try:
+            bytes.fromhex(value)
+        except ValueError:
+            return False
+        return True
+
+    def _widen(self, digest_size):
+        """Grow the width of the digests buffer, digests are right aligned in their slot"""
+        old = self.digest_size
+        pad = bytes(digest_size - old)
+        self.digests = bytearray().join([pad + self.digests[row*old:(row+1)*old] for row in range(len(self))])
+        self.digest_size = digest_size
@@ -0,0 +1,705 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os, sys, stat, time, struct, select, socket, signal, json, collections, ctypes, ctypes.util
+
+from pathlib import Path
+
+from fileshasher import HashStream, new_hasher
+
+# inotify(7) event masks
+IN_MODIFY       = 0x00000002
+IN_ATTRIB       = 0x00000004
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_MOVE_SELF    = 0x00000800
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+IN_ISDIR        = 0x40000000
+IN_NONBLOCK     = 0o4000
+IN_CLOEXEC      = 0o2000000
+
+WATCH_MASK      = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER    = 'iIII'    # wd, mask, cookie, len
+
+# Paths waiting to be checked. Past this many the events are dropped and the whole tree is checked again.
+MAX_PENDING     = 65536
+# Seconds a path has to go without events before it gets checked, a file being written is checked once
+SETTLE_TIME     = 1.0
+# Maximum number of files being hashed at once
+MAX_HASHING     = 1024
+# Files waiting to be hashed. Past this many they are left in the index and looked up again once the queue drains.
+MAX_QUEUED      = 65536
+# Seconds a client gets to take its answer, a slow client is dropped instead of holding the index updates
+CLIENT_TIMEOUT  = 5.0
+
+
+class Inotify():
+    """
+    Minimal inotify(7) binding with ctypes
+
+    The file descriptor is non blocking, use it with select() and call read() once it is readable.
+    """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask = WATCH_MASK):
+        """Watch a directory, return its watch descriptor. Raises OSError, ENOSPC once fs.inotify.max_user_watches is reached."""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), str(path))
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, size = 256*1024):
+        """
+        Read the events available
+
+        Return:
+            list:       [ (wd, mask, cookie, name), ... ] name is '' for events of the watched directory itself
+        """
+        try:
+            data = os.read(self.fd, size)
+        except BlockingIOError:
+            return []
+
+        events = []
+        header_size = struct.calcsize(EVENT_HEADER)
+        offset = 0
+        while offset + header_size <= len(data):
+            wd, mask, cookie, length = struct.unpack_from(EVENT_HEADER, data, offset)
+            name = data[offset + header_size: offset + header_size + length].rstrip(b'\0')
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+            offset += header_size + length
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PathTree():
+    """
+    Set of paths kept by their parent directory, to find the ones under a directory without going through all of them
+
+    A path is linked to its parent while it is in the set or has something under it, so the paths under a
+    directory are found walking only its subtree.
+    """
+
+    def __init__(self):
+        self.paths    = set()
+        self.children = {}      # directory: set(paths of its entries), only directories with something under them
+
+    def __contains__(self, path):
+        return path in self.paths
+
+    def add(self, path):
+        if path in self.paths:
+            return
+        self.paths.add(path)
+
+        # Link the path and its parents up to the first one that is already linked
+        while True:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return
+            children = self.children.setdefault(parent, set())
+            linked = bool(children) or parent in self.paths
+            children.add(path)
+            if linked:
+                return
+            path = parent
+
+    def discard(self, path):
+        if path not in self.paths:
+            return
+        self.paths.discard(path)
+
+        # Unlink the path and its parents left with nothing under them
+        while path not in self.paths and path not in self.children:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return
+            children = self.children[parent]
+            children.discard(path)
+            if children:
+                return
+            del self.children[parent]
+            path = parent
+
+    def has_children(self, directory):
+        """Whether there are paths under a directory"""
+        return directory in self.children
+
+    def under(self, directory):
+        """Return the paths under a directory"""
+        paths = []
+        stack = [directory]
+        while stack:
+            for child in self.children.get(stack.pop(), ()):
+                if child in self.paths:
+                    paths.append(child)
+                stack.append(child)
+        return paths
+
+
+class DuplicateIndex():
+    """
+    In memory index of the files of a tree by size and digest
+
+    Like stream_files, a file only gets hashed once another inode with its size shows up, and only one path
+    of each inode gets hashed, the other paths get its digest. The paths of a size are kept by inode, so adding,
+    hashing or removing a file only goes through the paths of its own inode.
+    """
+
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        self.empty_digest = new_hasher(algorithm).digest().hex().lower()
+        self.files    = {}    # path: {path, size, dev, ino, mtime_ns, hash}
+        self.sizes    = {}    # size: { (dev, ino): set(paths) }
+        self.hashes   = {}    # hash: set(paths)
+        self.inodes   = {}    # (dev, ino): {mtime_ns, hash, queued, paths} digest of the inode, record being hashed and number of paths
+        self.tree     = PathTree()
+        self.released = []    # records to hash in place of a removed path of their inode, taken by the daemon
+
+    def __len__(self):
+        return len(self.files)
+
+    def _set_hash(self, record, digest):
+        record['hash'] = digest
+        if digest is not None:
+            self.hashes.setdefault(digest, set()).add(record['path'])
+            inode = self.inodes.get((record['dev'], record['ino']))
+            if inode is not None and inode['mtime_ns'] == record['mtime_ns']:
+                inode['hash'] = digest
+
+    def update(self, item, digest = None):
+        """
+        Add or update a file
+
+        Parameters:
+            item:       {path, size, dev, ino, mtime_ns, [mode]} FIFOs, sockets and device nodes are dropped from the index
+            digest:     Digest of the file if it is known
+
+        Return:
+            list:       Records that have to be hashed, see hashed()
+        """
+        path = str(item['path'])
+        old = self.files.get(path)
+        if old is not None:
+            if (old['size'], old['dev'], old['ino'], old['mtime_ns']) == (item['size'], item['dev'], item['ino'], item['mtime_ns']):
+                return []
+            self.remove(path)
+
+        if not stat.S_ISREG(item.get('mode', stat.S_IFREG)):
+            return []
+
+        record = {'path': path, 'size': item['size'], 'dev': item['dev'], 'ino': item['ino'], 'mtime_ns': item['mtime_ns'], 'hash': None}
+        key = (record['dev'], record['ino'])
+        self.files[path] = record
+        self.tree.add(path)
+        self.sizes.setdefault(record['size'], {}).setdefault(key, set()).add(path)
+
+        inode = self.inodes.get(key)
+        if inode is None:
+            inode = self.inodes[key] = {'mtime_ns': record['mtime_ns'], 'hash': None, 'queued': None, 'paths': 0}
+        elif inode['mtime_ns'] != record['mtime_ns']:
+            # The inode changed since its other paths were read
+            inode.update({'mtime_ns': record['mtime_ns'], 'hash': None, 'queued': None})
+        inode['paths'] += 1
+
+        if record['size'] == 0:
+            digest = self.empty_digest
+
+        # Another path of the same inode
+        if digest is None:
+            digest = inode['hash']
+
+        if digest is not None:
+            self._set_hash(record, digest)
+            return []
+
+        return self.to_hash(record)
+
+    def _queue(self, record):
+        """Mark a record as being hashed, unless it is out of date, already hashed or another path of its inode is being hashed"""
+        if self.files.get(record['path']) is not record or record['hash'] is not None:
+            return False
+
+        inode = self.inodes[(record['dev'], record['ino'])]
+        queued = inode['queued']
+        if inode['hash'] is not None or (queued is not None and self.files.get(queued['path']) is queued):
+            return False
+
+        inode['queued'] = record
+        return True
+
+    def _queue_inode(self, key, paths):
+        """Return a path of an inode to hash, none if the inode is hashed or being hashed"""
+        for path in paths:
+            record = self.files[path]
+            if self._queue(record):
+                return [record]
+        return []
+
+    def to_hash(self, record):
+        """Return the records that have to be hashed once a record is added, none while all the paths of its size share their inode"""
+        key = (record['dev'], record['ino'])
+        inodes = self.sizes[record['size']]
+        if len(inodes) < 2:
+            return []
+
+        queue = []
+        if len(inodes) == 2:
+            # The size just stopped being unique, the other inode gets hashed too
+            for other, paths in inodes.items():
+                if other != key:
+                    queue += self._queue_inode(other, paths)
+
+        if self._queue(record):
+            queue.append(record)
+
+        return queue
+
+    def hashed(self, record):
+        """
+        Take a record back from the hashers
+
+        Return:
+            bool:       False if the file changed while it was hashed, it has to be checked again
+        """
+        if self.files.get(record['path']) is not record:
+            return True
+        if 'oldsize' in record:
+            record['size'] = record.pop('oldsize')
+            self.remove(record['path'])
+            return False
+
+        key = (record['dev'], record['ino'])
+        inode = self.inodes[key]
+        if inode['queued'] is record:
+            inode['queued'] = None
+
+        if record.get('error'):
+            record['hash'] = None
+            return True
+
+        digest = record['hash']
+        self._set_hash(record, digest)
+
+        # Other paths of the same inode
+        for path in self.sizes[record['size']][key]:
+            other = self.files[path]
+            if other['hash'] is None and other['mtime_ns'] == record['mtime_ns']:
+                self._set_hash(other, digest)
+
+        return True
+
+    def remove(self, path):
+        """Remove a file, return its record or None"""
+        record = self.files.pop(path, None)
+        if record is None:
+            return None
+        self.tree.discard(path)
+
+        key = (record['dev'], record['ino'])
+        inodes = self.sizes[record['size']]
+        inodes[key].discard(path)
+        if not inodes[key]:
+            del inodes[key]
+        if not inodes:
+            del self.sizes[record['size']]
+
+        paths = self.hashes.get(record['hash'])
+        if paths is not None:
+            paths.discard(path)
+            if not paths:
+                del self.hashes[record['hash']]
+
+        inode = self.inodes[key]
+        inode['paths'] -= 1
+        if not inode['paths']:
+            del self.inodes[key]
+        elif inode['queued'] is record:
+            # Another path of the inode gets hashed in its place
+            inode['queued'] = None
+            if len(inodes) > 1:
+                self.released += self._queue_inode(key, inodes.get(key, ()))
+
+        return record
+
+    def unqueue(self, record):
+        """Forget that a record was returned to be hashed, find_unhashed() returns it again"""
+        inode = self.inodes.get((record['dev'], record['ino']))
+        if inode is not None and inode['queued'] is record:
+            inode['queued'] = None
+
+    def find_unhashed(self, limit):
+        """Return up to limit records to hash, a path of each inode that shares its size and isn't hashed, being hashed or unreadable"""
+        queue = []
+        for inodes in self.sizes.values():
+            if len(inodes) < 2:
+                continue
+            for key, paths in inodes.items():
+                for path in paths:
+                    record = self.files[path]
+                    if not record.get('error') and self._queue(record):
+                        queue.append(record)
+                        break
+                if len(queue) >= limit:
+                    return queue
+        return queue
+
+    def files_under(self, directory):
+        """Return the paths of the files under a directory"""
+        return [path for path in self.tree.under(directory) if path in self.files]
+
+    def remove_tree(self, directory):
+        """Remove the files under a directory, return their paths"""
+        paths = self.files_under(directory)
+        for path in paths:
+            self.remove(path)
+        return paths
+
+    def groups(self):
+        """
+        Return the current repeated files
+
+        Return:
+            dict:       { hash: {[files], size}, ... } only groups with more than one inode
+        """
+        groups = {}
+        for digest, paths in self.hashes.items():
+            records = [self.files[path] for path in paths]
+            if len(set([(record['dev'], record['ino']) for record in records])) > 1:
+                groups[digest] = {'size': records[0]['size'], 'files': sorted(paths)}
+        return groups
+
+
+class WatchDaemon():
+    """
+    Keep a DuplicateIndex of some directories up to date with inotify and answer queries on a unix socket
+
+    The events are coalesced by path: a path only gets checked once it has gone SETTLE_TIME without events, and then
+    its current state is read with stat(), no matter how many events it had. Up to MAX_PENDING paths wait to be
+    checked, past that, or when the kernel queue overflows, the events are dropped and all the directories are
+    checked again. At most MAX_HASHING files are hashed at once, the rest wait in a queue of up to MAX_QUEUED files.
+    The files that don't fit are looked up in the index again once the queue drains. Answers are sent without
+    blocking, a client that doesn't take its answer in CLIENT_TIMEOUT seconds is dropped.
+
+    Clients send a line with a command and get back a line of JSON:
+        groups      { hash: {[files], size}, ... }
+        stats       {files, hashed, repeated, pending, hashing, watches, rescans}
+    """
+
+    def __init__(self, paths, socket_path, cpu_threads, algorithm, scan, cache = None, **read_options):
+        """
+        Parameters:
+            paths:          Directories to watch
+            socket_path:    Path of the unix socket to listen on
+            cpu_threads:    Hashing processes of each device. See HashStream
+            algorithm:      Algorithm of the digests
+            scan:           function(path, listing) yielding the {path, size, dev, ino, mtime_ns} files of a directory
+                            and filling listing with its subdirectories. See scan_tree
+            cache:          HashCache to look the digests up in and store them to, or None
+            read_options:   chunk_size, mmap_min_size and profile_dir of QueuedFileHasher_mp
+        """
+        self.paths       = [str(Path(path).absolute()) for path in paths]
+        self.socket_path = socket_path
+        self.scan        = scan
+        self.cache       = cache
+        self.index       = DuplicateIndex(algorithm)
+        self.hasher      = HashStream(cpu_threads, algorithm, **read_options)
+        self.inotify     = Inotify()
+        self.watches     = {}       # wd: directory
+        self.watched     = {}       # directory: wd
+        self.watch_tree  = PathTree()
+        self.pending     = collections.OrderedDict()   # path: time of its last event
+        self.to_hash     = collections.deque()
+        self.backlog     = False    # files to hash were left in the index
+        self.overflow    = False
+        self.rescans     = 0
+        self.server      = None
+        self.clients     = {}       # socket: received bytes
+        self.replies     = {}       # socket: [bytes left to send, deadline]
+
+    def load(self, files, listing):
+        """
+        Fill the index with the files of the initial scan and watch its directories
+
+        Parameters:
+            files:      [ {path, size, dev, ino, mtime_ns, [hash]}, ... ] files of a scan. See stream_files
+            listing:    { directory: (mtime_ns, ...), ... } directories of the scan. See dir_scan
+        """
+        for item in files:
+            self.queue_hash(self.index.update(item, item.get('hash')))
+
+        # Directories that changed before they got watched are checked again
+        for directory, entry in listing.items():
+            self.watch(directory)
+            try:
+                if os.stat(directory).st_mtime_ns != entry[0]:
+                    self.pending[directory] = 0
+            except OSError:
+                self.pending[directory] = 0
+
+    def watch(self, directory):
+        if directory in self.watched:
+            return
+        try:
+            wd = self.inotify.add_watch(directory)
+        except OSError as e:
+            print(f'Error watching {directory}. {e}')
+            return
+
+        # A directory moved inside the tree keeps its watch descriptor
+        self.forget_watch(wd)
+        self.watches[wd] = directory
+        self.watched[directory] = wd
+        self.watch_tree.add(directory)
+
+    def forget_watch(self, wd):
+        directory = self.watches.pop(wd, None)
+        if directory is not None:
+            del self.watched[directory]
+            self.watch_tree.discard(directory)
+
+    def unwatch_tree(self, directory):
+        for path in [directory] + self.watch_tree.under(directory):
+            wd = self.watched.get(path)
+            if wd is not None:
+                self.inotify.rm_watch(wd)
+                self.forget_watch(wd)
+
+    def queue_hash(self, records):
+        room = MAX_QUEUED - len(self.to_hash)
+        self.to_hash.extend(records[:room])
+        for record in records[room:]:
+            self.index.unqueue(record)
+            self.backlog = True
+
+    def check(self, path):
+        """Bring a path in the index up to date with what is on disk"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.index.remove(path)
+            # A directory that was deleted or moved away takes its files and subdirectories with it
+            if path in self.watched or self.index.tree.has_children(path):
+                self.index.remove_tree(path)
+                self.unwatch_tree(path)
+            return
+
+        if os.path.isdir(path):
+            self.sync_tree(path)
+        else:
+            self.queue_hash(self.index.update({'path': path, 'size': st.st_size, 'dev': st.st_dev, 'ino': st.st_ino, 'mtime_ns': st.st_mtime_ns,
+                                               'mode': st.st_mode}))
+
+    def sync_tree(self, directory):
+        """Scan a directory again, adding its files to the index and dropping the ones that are gone"""
+        listing = {}
+        seen = set()
+        for item in self.scan(directory, listing):
+            seen.add(str(item['path']))
+            self.queue_hash(self.index.update(item))
+
+        for path in self.index.files_under(directory):
+            if path not in seen:
+                self.index.remove(path)
+
+        for subdirectory in listing:
+            self.watch(subdirectory)
+
+    def rescan(self):
+        """Drop the pending events and check every directory again"""
+        self.pending.clear()
+        self.overflow = False
+        self.rescans += 1
+        for path in self.paths:
+            self.sync_tree(path)
+
+    def handle_events(self):
+        now = time.monotonic()
+        for wd, mask, cookie, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                self.overflow = True
+                continue
+
+            directory = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.forget_watch(wd)
+                continue
+            if directory is None or self.overflow:
+                continue
+
+            path = os.path.join(directory, name) if name else directory
+            self.pending.pop(path, None)
+            self.pending[path] = now
+
+            if len(self.pending) > MAX_PENDING:
+                self.overflow = True
+
+        if self.overflow:
+            print('Too many events, checking all the files again')
+            self.rescan()
+
+    def process_pending(self):
+        """Check the paths that settled, oldest first"""
+        deadline = time.monotonic() - SETTLE_TIME
+        while self.pending:
+            path, last = next(iter(self.pending.items()))
+            if last > deadline:
+                break
+            del self.pending[path]
+            self.check(path)
+
+    def process_hashes(self):
+        """Send the queued files to the hashers and take the hashed ones back"""
+        if self.index.released:
+            self.queue_hash(self.index.released)
+            self.index.released = []
+
+        # Records removed from the index while they waited are dropped, another path of their inode took their place
+        if self.backlog and not self.to_hash:
+            self.to_hash.extend(self.index.find_unhashed(MAX_QUEUED))
+            self.backlog = len(self.to_hash) == MAX_QUEUED
+
+        batch = []
+        while self.to_hash and self.hasher.pending + len(batch) < MAX_HASHING:
+            record = self.to_hash.popleft()
+            if self.index.files.get(record['path']) is record:
+                batch.append(record)
+
+        if batch and self.cache is not None:
+            batch, hits = self.cache.lookup(batch, self.index.algorithm)
+            for record in hits:
+                self.index.hashed(record)
+        if batch:
+            self.hasher.submit(batch)
+
+        hashed = self.hasher.results()
+        if hashed and self.cache is not None:
+            self.cache.store([record for record in hashed if record.get('hash') and not record.get('error')], self.index.algorithm)
+        for record in hashed:
+            if not self.index.hashed(record):
+                self.pending[record['path']] = time.monotonic()
+
+    def answer(self, client, command):
+        if command == 'groups':
+            response = self.index.groups()
+        elif command == 'stats':
+            response = {'files': len(self.index), 'hashed': sum([len(paths) for paths in self.index.hashes.values()]),
+                        'repeated': len(self.index.groups()), 'pending': len(self.pending),
+                        'hashing': self.hasher.pending + len(self.to_hash), 'watches': len(self.watches), 'rescans': self.rescans}
+        else:
+            response = {'error': f'Unknown command: {command}'}
+
+        self.replies[client] = [json.dumps(response).encode('utf-8') + b'\n', time.monotonic() + CLIENT_TIMEOUT]
+        self.send_reply(client)
+
+    def send_reply(self, client):
+        """Send what the client takes of its answer without blocking, close it once sent"""
+        reply = self.replies[client]
+        try:
+            sent = client.send(reply[0])
+        except BlockingIOError:
+            return
+        except OSError:
+            sent = len(reply[0])
+
+        reply[0] = reply[0][sent:]
+        if not reply[0]:
+            del self.replies[client]
+            client.close()
+
+    def drop_slow_clients(self):
+        now = time.monotonic()
+        for client in [client for client, (data, deadline) in self.replies.items() if deadline < now]:
+            del self.replies[client]
+            client.close()
+
+    def handle_client(self, client):
+        try:
+            data = client.recv(4096)
+        except OSError:
+            data = b''
+
+        if data:
+            self.clients[client] += data
+            if b'\n' not in self.clients[client] and len(self.clients[client]) < 4096:
+                return
+            command = self.clients.pop(client).split(b'\n')[0].decode('utf-8', 'replace').strip()
+            self.answer(client, command)
+            return
+
+        del self.clients[client]
+        client.close()
+
+    def run(self):
+        """Serve until interrupted or terminated, the socket file is removed either way"""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        self.server.listen(16)
+        self.server.setblocking(False)
+
+        print(f'Watching {len(self.watches)} directories, {len(self.index)} files. Listening on {self.socket_path}')
+
+        # SIGTERM ends the loop like an interruption, so the cleanup below runs
+        previous_handler = signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True:
+                # The hashers wake the loop up when they send a batch back, only the settling events need a short timeout
+                busy = self.pending or self.to_hash or self.backlog or self.replies
+                hashers = self.hasher.connections()
+                readable, writable, _ = select.select([self.inotify, self.server] + list(self.clients) + hashers, list(self.replies), [],
+                                                      0.1 if busy else 1)
+
+                for client in writable:
+                    self.send_reply(client)
+                self.drop_slow_clients()
+
+                for source in readable:
+                    if source in hashers:
+                        continue    # taken by process_hashes()
+                    elif source is self.inotify:
+                        self.handle_events()
+                    elif source is self.server:
+                        try:
+                            client, address = self.server.accept()
+                            client.setblocking(False)
+                            self.clients[client] = b''
+                        except OSError:
+                            pass
+                    else:
+                        self.handle_client(source)
+
+                self.process_pending()
+                self.process_hashes()
+
+        finally:
+            self.hasher.stop()
+            self.server.close()
+            for client in list(self.clients) + list(self.replies): client.close()
+            self.inotify.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            signal.signal(signal.SIGTERM, previous_handler)
@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import time, sqlite3
+
+from pathlib import Path
+
+from filetable import subset_of
+
+
+def file_identity(item):
+    """
+    Return the identity and modification stamp of a file. Uses the values recorded by dir_scan when available.
+
+    Parameters:
+        item:       {path, size, [dev, ino, mtime_ns]}
+
+    Return:
+        tuple:      (dev, ino, size, mtime_ns)
+    """
+    if not all(k in item for k in ('dev', 'ino', 'mtime_ns')):
+        st = Path(item['path']).stat()
+        item.update({'dev': st.st_dev, 'ino': st.st_ino, 'mtime_ns': st.st_mtime_ns})
+
+    return (item['dev'], item['ino'], item['size'], item['mtime_ns'])
+
+def _i64(value):
+    """Fold an unsigned 64 bit value (some inode and device numbers) into the signed range sqlite can store"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+class HashCache():
+    """
+    Persistent cache of file digests stored in a sqlite database.
+
+    Entries are stored under the file identity (st_dev, st_ino) and the algorithm, together with the size and
+    mtime_ns of the file when it was hashed. An entry is only used if the size and mtime_ns still match, otherwise it
+    is stale and gets replaced the next time the file is hashed.
+    """
+
+    def __init__(self, path, max_entries = 0):
+        """
+        Open or create the cache database
+
+        Parameters:
+            path:           Path to the sqlite file
+            max_entries:    Maximum number of entries to keep, least recently used ones get evicted first. 0 means no limit.
+        """
+        self.path = Path(path)
+        self.max_entries = max_entries
+
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS hashes (
+                dev         INTEGER NOT NULL,
+                ino         INTEGER NOT NULL,
+                algorithm   TEXT    NOT NULL,
+                size        INTEGER NOT NULL,
+                mtime_ns    INTEGER NOT NULL,
+                digest      TEXT    NOT NULL,
+                last_used   INTEGER NOT NULL,
+                PRIMARY KEY (dev, ino, algorithm)
+            ) WITHOUT ROWID""")
+        self.db.execute('CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used)')
+        self.db.commit()
+
+    def close(self):
+        """Evict the entries over the limit and close the database"""
+        self.evict()
+        self.db.close()
+
+    def lookup(self, files, algorithm):
+        """
+        Look up the digests of a list of files
+
+        Parameters:
+            files:      [ {path, size}, ... ]
+            algorithm:  Algorithm tag the digests were stored under
+
+        Return:
+            tuple:      ( [misses], [hits] ). Hits get updated with {hash, hash_algorithm, cached}
+                        FileRows for the rows of a FileTable
+        """
+        now = int(time.time())
+        misses = subset_of(files)
+        hits = subset_of(files)
+        used = []
+
+        cursor = self.db.cursor()
+        for item in files:
+            try:
+                dev, ino, size, mtime_ns = file_identity(item)
+            except OSError:
+                item.pop('cached', None)
+                misses.append(item); continue
+
+            row = cursor.execute('SELECT size, mtime_ns, digest FROM hashes WHERE dev=? AND ino=? AND algorithm=?',
+                                 (_i64(dev), _i64(ino), algorithm)).fetchone()
+
+            if row and row[0] == size and row[1] == mtime_ns:
+                item.update({'hash': row[2], 'hash_algorithm': algorithm, 'cached': True})
+                hits.append(item)
+                used.append((now, _i64(dev), _i64(ino), algorithm))
+            else:
+                item.pop('cached', None)
+                misses.append(item)
+
+        cursor.executemany('UPDATE hashes SET last_used=? WHERE dev=? AND ino=? AND algorithm=?', used)
+        self.db.commit()
+
+        return misses, hits
+
+    def store(self, files, algorithm):
+        """
+        Store the digests of a list of hashed files. Files that failed to hash are ignored.
+
+        Parameters:
+            files:      [ {path, size, hash}, ... ]
+            algorithm:  Algorithm tag to store the digests under
+        """
+        now = int(time.time())
+        rows = []
+
+        for item in files:
+            if item.get('hash') is None or item.get('error'):
+                continue
+            try:
+                dev, ino, size, mtime_ns = file_identity(item)
+            except OSError:
+                continue
+
+            rows.append((_i64(dev), _i64(ino), algorithm, size, mtime_ns, item['hash'], now))
+
+        self.db.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        self.db.commit()
+
+    def invalidate(self, files):
+        """
+        Remove the entries of a list of files, for all the algorithms
+
+        Parameters:
+            files:      [ {path, size}, ... ]
+        """
+        keys = []
+        for item in files:
+            try:
+                dev, ino, size, mtime_ns = file_identity(item)
+            except OSError:
+                continue
+            keys.append((_i64(dev), _i64(ino)))
+
+        self.db.executemany('DELETE FROM hashes WHERE dev=? AND ino=?', keys)
+        self.db.commit()
+
+    def clear(self):
+        """Remove all the entries"""
+        self.db.execute('DELETE FROM hashes')
+        self.db.commit()
+
+    def evict(self):
+        """Remove the least recently used entries over max_entries"""
+        if not self.max_entries:
+            return
+
+        count = self.db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute("""
+                DELETE FROM hashes WHERE (dev, ino, algorithm) IN (
+                    SELECT dev, ino, algorithm FROM hashes ORDER BY last_used ASC LIMIT ?
+                )""", (count - self.max_entries,))
+            self.db.commit()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os, time, json, threading, contextlib
+
+import psutil
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss():
+    """
+    Return the peak resident memory of this process and of its children that were waited for
+
+    Return:
+        tuple:      (bytes, bytes). Without the resource module (Windows) the peak working set of this process and 0.
+    """
+    if resource is None:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss), 0
+
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    unit = 1 if psutil.MACOS else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit)
+
+class PhasePeak():
+    """
+    Peak resident memory of this process and of its hashing processes while a phase runs
+
+    ru_maxrss only ever grows over the run. When it grew during the phase the new value is the peak of the phase,
+    otherwise the phase stayed below an earlier peak and the highest RSS sampled by a thread is taken instead. The
+    children are sampled alone, the processes of a phase are still running when it ends.
+    """
+
+    def __init__(self, interval = 0.1):
+        """
+        Parameters:
+            interval:   Seconds between two samples
+        """
+        self.interval = interval
+        self.process = psutil.Process()
+        self.rss = 0
+        self.children_rss = 0
+        self.done = threading.Event()
+        self.thread = threading.Thread(target = self.run, daemon = True, name = 'rss')
+
+    def sample(self):
+        try:
+            self.rss = max(self.rss, self.process.memory_info().rss)
+            self.children_rss = max(self.children_rss, sum([child.memory_info().rss for child in self.process.children(recursive = True)]))
+        except psutil.Error:
+            pass    # a child exited while being sampled
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.before = peak_rss()[0]
+        self.sample()
+        self.thread.start()
+
+    def stop(self):
+        """
+        Return:
+            tuple:      (bytes, bytes) peak of this process and of its children during the phase
+        """
+        self.done.set()
+        self.thread.join()
+        self.sample()
+        after = peak_rss()[0]
+        return (after if after > self.before else self.rss), self.children_rss
+
+def cpu_time():
+    """Return the CPU seconds used by this process and its children that were waited for, like the hashing processes"""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class Metrics():
+    """
+    Timings and counters of each phase of a run
+
+    Each phase records {wall_time, cpu_time, files, bytes, errors, peak_rss, children_peak_rss, workers}, the peaks
+    are the ones of the phase alone, see PhasePeak. The
+    hashing phases add the get_worker_stats of their workers, with the stage they hashed in. The metrics can be
+    written as JSON and as a Prometheus textfile for the node_exporter textfile collector.
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name, files = 0, size = 0):
+        """
+        Time a phase. Yields its dict so the counters can be filled in while it runs.
+
+        Parameters:
+            name:       Name of the phase, a phase run twice adds up
+            files:      Files the phase goes through, if known beforehand
+            size:       Bytes the phase goes through, if known beforehand
+        """
+        phase = self.phases.setdefault(name, {'wall_time': 0.0, 'cpu_time': 0.0, 'files': 0, 'bytes': 0, 'errors': 0,
+                                              'peak_rss': 0, 'children_peak_rss': 0, 'workers': []})
+        phase['files'] += files
+        phase['bytes'] += size
+
+        memory = PhasePeak()
+        memory.start()
+        cpu = cpu_time()
+        start = time.perf_counter()
+        try:
+            yield phase
+        finally:
+            phase['wall_time'] += time.perf_counter() - start
+            phase['cpu_time'] += cpu_time() - cpu
+            rss, children_rss = memory.stop()
+            phase['peak_rss'] = max(phase['peak_rss'], rss)
+            phase['children_peak_rss'] = max(phase['children_peak_rss'], children_rss)
+
+    def result(self):
+        """
+        Return:
+            dict:       {start_time, wall_time, phases: {name: {...}, ...}}
+        """
+        return {'start_time': self.start_time, 'wall_time': time.time() - self.start_time, 'phases': self.phases}
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            f.write(json.dumps(self.result(), indent=4, default=str))
+
+    def write_prometheus(self, path, prefix = 'pydelete'):
+        """
+        Write the metrics in the Prometheus text format
+
+        The file is written next to path and renamed over it, so the collector never reads a partial file.
+        """
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        phase_metrics = [
+            ('wall_time',           'phase_wall_seconds',       'Wall time of the phase'),
+            ('cpu_time',            'phase_cpu_seconds',        'CPU time of the phase, hashing processes included'),
+            ('files',               'phase_files',              'Files processed by the phase'),
+            ('bytes',               'phase_bytes',              'Bytes processed by the phase'),
+            ('errors',              'phase_errors',             'Errors in the phase'),
+            ('peak_rss',            'phase_peak_rss_bytes',     'Peak resident memory during the phase'),
+            ('children_peak_rss',   'phase_children_peak_rss_bytes', 'Peak resident memory of the hashing processes during the phase'),
+            ]
+        worker_metrics = [
+            ('files',       'worker_files',         'Files hashed by the worker'),
+            ('read_size',   'worker_read_bytes',    'Bytes read by the worker'),
+            ('read_calls',  'worker_read_calls',    'Read calls of the worker'),
+            ('read_time',   'worker_read_seconds',  'Seconds the worker waited on reads'),
+            ('hash_time',   'worker_hash_seconds',  'Seconds the worker spent hashing'),
+            ('busy_time',   'worker_busy_seconds',  'Seconds the worker was busy'),
+            ('errors',      'worker_errors',        'Files the worker failed to hash'),
+            ]
+
+        lines = []
+        result = self.result()
+        for key, name, description in [('start_time', 'last_run_timestamp_seconds', 'Start time of the last run'),
+                                       ('wall_time', 'run_seconds', 'Wall time of the last run')]:
+            lines += [f'# HELP {prefix}_{name} {description}', f'# TYPE {prefix}_{name} gauge', f'{prefix}_{name} {result[key]}']
+
+        for key, name, description in phase_metrics:
+            lines += [f'# HELP {prefix}_{name} {description}', f'# TYPE {prefix}_{name} gauge']
+            for phase, values in self.phases.items():
+                lines.append(f'{prefix}_{name}{{phase="{label(phase)}"}} {values[key]}')
+
+        for key, name, description in worker_metrics:
+            lines += [f'# HELP {prefix}_{name} {description}', f'# TYPE {prefix}_{name} gauge']
+            for phase, values in self.phases.items():
+                for worker in values['workers']:
+                    lines.append(f'{prefix}_{name}{{phase="{label(phase)}",stage="{label(worker.get("stage", ""))}",worker="{label(worker["name"])}",'
+                                 f'device="{worker["device"]}"}} {worker[key]}')
+
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, path)
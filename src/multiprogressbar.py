@@ -4,12 +4,57 @@
 # MultiProgressBar
 # Version: 1.0.0b
 
-import sys, threading, platform, time
+import sys, threading, platform, time, signal
 import python_utils.terminal
 
 # Deps: python -m pip install <library>
 # python -m pip install python_utils
 
+# Seconds between the log lines written instead of the bars when the output isn't a terminal, 0 to only write
+# the last one
+NON_TTY_INTERVAL = 10
+
+_windows = platform.system() == "Windows"
+_terminal_width = None
+
+
+def _sigwinch(signum, frame):
+    global _terminal_width
+    _terminal_width = None
+    if callable(_previous_sigwinch):
+        _previous_sigwinch(signum, frame)
+
+_previous_sigwinch = None
+try:
+    _previous_sigwinch = signal.signal(signal.SIGWINCH, _sigwinch)
+except (AttributeError, ValueError):
+    pass    # No SIGWINCH on Windows, or imported outside the main thread: the width is read once
+
+def terminal_width():
+    """Return the width of the terminal. It is read once and again after each SIGWINCH."""
+    global _terminal_width
+    if _terminal_width is None:
+        _terminal_width = python_utils.terminal.get_terminal_size()[0]
+    return _terminal_width
+
+def is_tty():
+    """Whether stdout is a terminal the bars can be drawn on"""
+    try:
+        return sys.stdout.isatty()
+    except (AttributeError, ValueError):
+        return False
+
+def print_progress(text):
+    """Write a progress line over the previous one on a terminal, or as a line of its own otherwise"""
+    if is_tty():
+        print('\r' + text, end='')
+    else:
+        print(text)
+
+def progress_rate():
+    """Progress updates per second for a timed_tigger, less often when the output isn't a terminal"""
+    return 10 if is_tty() else 1/max(NON_TTY_INTERVAL, 1)
+
 class bcolors:
     HEADER = '\033[95m'
     OKBLUE = '\033[94m'
@@ -37,72 +82,63 @@ class _witness():
     PRESET12 = "⠁⠂⠄⡀⢀⠠⠐⠈"
 
     def __init__(self, speed = 0.5, charset = "" ):
+        """The spinner turns one step per call to spin(), at most once every speed seconds"""
         self.speed = speed
         self.charset = charset
 
         self.i = 0
-
-        self.local = threading.local()
-        self.properties_lock = threading.RLock()
-
-        self.repeater = repeater(speed, self.spin, True)
+        self.last_spin = 0.0
 
     def get_char(self):
-        self.properties_lock.acquire()
-        try:
-            self.local.s = self.charset[self.i]
-        except:
-            self.i = 0
-            self.local.s = self.charset[self.i]
-
-        self.properties_lock.release()
-
-        return self.local.s
+        if not self.charset:
+            return ""
+        return self.charset[self.i % len(self.charset)]
 
     def spin(self):
-        self.properties_lock.acquire()
-
-        if len(self.charset) < 1:
-            self.i = 0
-        else:
-            self.i = (self.i + 1) % len(self.charset)
-
-        self.properties_lock.release()
-
-
-class repeater():
-    def __init__(self, speed = 0.1, function = None, autostart = False):
-        self.speed = speed
-        self.function = function
-
-        self.timer = threading.Thread(target=self.repeat)
-        self.timer.daemon = True
-
-        self.timer_lock = threading.RLock()
-        self.timer_run = threading.Event()
-
-        self.exit = threading.Event()
-
-
-        self.timer.start()
-        if autostart: self.timer_run.set()
-
-    def __del__(self):
-        self.exit.set()
-        self.timer_run.set()
-
-    def repeat(self):
-        while not self.exit.is_set():
-            time.sleep(self.speed)
-            if self.timer_run.is_set(): self.function()
-            self.timer_run.wait()
-
-    def start(self):
-        self.timer_run.set()
-
-    def stop(self):
-        self.timer_run.clear()
-
+        now = time.monotonic()
+        if now - self.last_spin >= self.speed:
+            self.last_spin = now
+            self.i = (self.i + 1) % max(len(self.charset), 1)
+
+
+class _renderer():
+    """
+    Single thread drawing every started MultiProgressBar
+
+    It wakes up at the fastest update_rate of the bars, and a bar only gets written when its line changed.
+    """
+
+    lock = threading.Lock()
+    bars = []
+    thread = None
+
+    @classmethod
+    def add(cls, bar):
+        with cls.lock:
+            if bar not in cls.bars:
+                cls.bars.append(bar)
+            if cls.thread is None:
+                cls.thread = threading.Thread(target=cls.run, daemon=True, name='progress')
+                cls.thread.start()
+
+    @classmethod
+    def remove(cls, bar):
+        with cls.lock:
+            if bar in cls.bars:
+                cls.bars.remove(bar)
+
+    @classmethod
+    def run(cls):
+        while True:
+            with cls.lock:
+                bars = list(cls.bars)
+                if not bars:
+                    cls.thread = None
+                    return
+
+            for bar in bars:
+                bar.print_bar()
+            time.sleep(min([bar.update_rate for bar in bars]))
 
 
 class MultiProgressBar():
@@ -142,6 +178,12 @@ class MultiProgressBar():
         self.print_lock = threading.RLock()
 
         self.spinner = _witness(0.1,_witness.PRESET11)
+
+        # Without a terminal a log line is written every NON_TTY_INTERVAL seconds instead of the bars
+        self.tty = is_tty()
+        self.last_line = None
+        self.last_values = None
+        self.last_log = time.monotonic()
 #         if platform.system() == "Windows":
 #             self.spinner.charset = _witness.PRESET1
 
@@ -165,12 +207,12 @@ class MultiProgressBar():
 
             v = max(c, a)
 
-            if platform.system() != "Windows": s += self.bars_color[i]
+            if not _windows: s += self.bars_color[i]
             s += self.bars_chrs[i] * (v - a)
 
             a += (v - a)
 
-        if platform.system() != "Windows": s += bcolors.ENDC
+        if not _windows: s += bcolors.ENDC
         s += " "* (self.bars_lenght - a)
 
         # -- Calculate progress --
@@ -186,27 +228,56 @@ class MultiProgressBar():
         ret =  "%s[%s] %s %s%s" % (self.pretext, s, p, self.spinner.get_char(), self.endtext)
         
         # -- Cut so it wont overflow the terminal and clear the rest --
-        if not self.terminal_width:
-            w, h = python_utils.terminal.get_terminal_size()
-            ret += " "*(w-len(ret))
-            ret = ret[:w]
-        else:
-            ret += " "*(self.terminal_width-len(ret))
-            ret = ret[:self.terminal_width]
+        w = self.terminal_width or terminal_width()
+        ret += " "*(w-len(ret))
+        ret = ret[:w]
         
         
         self.properties_lock.release()
 
         return ret
 
-    def print_bar(self):
+    def gen_log_line(self):
+        """The progress as a plain line, for an output that isn't a terminal"""
+        i = self.bars_indicator
+        b = (self.bars[i] / self.bars_max[i]) * 100 if self.bars_max[i] else 0.0
+        return ("%.2f%% %s" % (b, self.endtext.strip())).rstrip()
+
+    def print_bar(self, force = False):
+        """Write the bar if anything changed since the last time, or a log line without a terminal"""
         self.properties_lock.acquire()
-        self.local.print_bar_b = ("\r%s" % self.gen_bar()).encode("utf-8", errors='surrogateescape')
 
-        try:
-            sys.stdout.write(self.local.print_bar_b.decode(sys.stdout.encoding, errors='surrogateescape'))
-        except:
-            sys.stdout.write(self.local.print_bar_b.decode(sys.stdout.encoding, errors='replace'))
+        values = (tuple(self.bars), tuple(self.bars_max), self.endtext, self.pretext)
+        changed = values != self.last_values
+        if changed:
+            self.spinner.spin()
+        self.last_values = values
+
+        if not self.tty:
+            now = time.monotonic()
+            if force or (changed and NON_TTY_INTERVAL and now - self.last_log >= NON_TTY_INTERVAL):
+                self.last_log = now
+                line = self.gen_log_line()
+                if force or line != self.last_line:
+                    self.last_line = line
+                    sys.stdout.write(line + "\n")
+            self.properties_lock.release()
+            return
+
+        if not (force or changed):
+            self.properties_lock.release()
+            return
+
+        line = self.gen_bar()
+        if force or line != self.last_line:
+            self.last_line = line
+            self.local.print_bar_b = ("\r%s" % line).encode("utf-8", errors='surrogateescape')
+
+            try:
+                sys.stdout.write(self.local.print_bar_b.decode(sys.stdout.encoding, errors='surrogateescape'))
+            except:
+                sys.stdout.write(self.local.print_bar_b.decode(sys.stdout.encoding, errors='replace'))
+            sys.stdout.flush()
 
         self.properties_lock.release()
 
@@ -254,10 +325,10 @@ class MultiProgressBar():
 
 
         if self.timer == None:
-            self.timer = repeater(self.update_rate, self.print_bar)
-            self.timer.start()
+            self.timer = _renderer
+            _renderer.add(self)
 
-        if now: self.print_bar()
+        if now: self.print_bar(True)
 
         self.properties_lock.release()
 
@@ -265,12 +336,10 @@ class MultiProgressBar():
         self.properties_lock.acquire()
 
         if self.timer != None:
-            self.timer.stop()
-
-            del self.timer
+            _renderer.remove(self)
             self.timer = None
 
-        if now: self.print_bar()
+        if now: self.print_bar(True)
 
         self.properties_lock.release()
 
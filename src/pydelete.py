@@ -5,14 +5,20 @@
 
 # Deps: python -m pip install pywin32
 
-import sys, os, time, signal, math, stat, itertools, argparse, json, datetime, time
-import multiprocessing, threading, requests, queue, platform, unicodedata
+import sys, os, time, signal, math, stat, errno, gc, itertools, argparse, json, csv, datetime, time
+import multiprocessing, threading, queue, platform, unicodedata, cProfile
 
 from pathlib import Path
 
 from pydelete_utils     import *
 from multiprogressbar   import *
 from fileshasher        import *
+from hashcache          import HashCache
+from filetable          import FileTable, FileRows, subset_of
+from snapshot           import Snapshot, diff_groups
+from filewatcher        import WatchDaemon
+from metrics            import Metrics
+from filecompare        import split_for_compare, compare_groups, COMPARE_MAX_FILES, COMPARE_MIN_SIZE
 
 # Options
 # place_synlink = False
@@ -23,22 +29,45 @@ from fileshasher        import *
 
 # Variables
 HASH_ALGORITHM = "sha1"
+SAMPLE_SIZE    = 4096 # Head and tail bytes hashed before the full digest
 cpu_threads    = os.cpu_count()
 
-def get_file_pos(path):
+# Devices where FIEMAP isn't supported, their files are ordered by inode number
+_no_fiemap_devices = set()
+
+# Files and directories the scans failed to read, for the metrics
+scan_errors = [0]
+
+def get_file_pos(path, item = None):
     """
     Return a number to represent the position of a file in a disk
 
+    On Linux it is the physical offset of the first extent of the file, or its inode number if the
+    filesystem doesn't support FIEMAP. Only regular files are opened, FIFOs, sockets and device nodes get
+    their inode number.
+
     Parameters:
         path:        path to the file
+        item:        {dev, ino, mode} of the file recorded by the scan, the file is stat'ed if None
     
     return:
         Dict        {pos}
     """
     if os.name == 'nt':
         return { 'pos': get_file_LCN(path)['LCNn'] } 
-    else:
-        return { 'pos': Path(path).stat().st_ino } 
+
+    if item is None:
+        st = os.stat(path)
+        item = {'dev': st.st_dev, 'ino': st.st_ino, 'mode': st.st_mode}
+
+    if sys.platform.startswith('linux') and stat.S_ISREG(item['mode']) and item['dev'] not in _no_fiemap_devices:
+        try:
+            return { 'pos': get_file_physical(path)['physical'] }
+        except OSError as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+                _no_fiemap_devices.add(item['dev'])
+
+    return { 'pos': item['ino'] } 
 
 def get_file_LCN(path):
     """
@@ -51,7 +80,260 @@ def get_file_LCN(path):
 
     return { 'LCNn': GET_RETRIEVAL_POINTERS(path)[3] }
 
-def dir_scan(path, recusive = True, symlinks = True, abs = False, file_callback = None, progress_callback = None):
+def get_file_physical(path):
+    """
+    Get the physical offset of the first extent of a file. Files without extents are at 0
+
+    path:        path to the file
+
+    return:     {physical}
+    """
+    extents = FIEMAP(path, 1)
+
+    return { 'physical': extents[1][1] if extents[0] else 0 }
+
+def _file_record(path, st, symlink = False):
+    """Make the internal item of a file from its stat result"""
+    return {'path': path, 'size': st.st_size, 'dev': st.st_dev, 'ino': st.st_ino, 'mtime_ns': st.st_mtime_ns,
+            'nlink': st.st_nlink, 'symlink': symlink, 'mode': st.st_mode}
+
+def _scan_roots(path, symlinks = True, abs = False):
+    """
+    Split the paths given to a scan in files and directories to walk
+
+    return:     ( [ {path, size, dev, ino, mtime_ns, nlink, symlink, mode}, ... ], [directory, ...] )
+    """
+    if not isinstance(path, list):
+        path = [path]
+
+    files = []
+    directories = []
+    for root in path:
+        root = Path(root)
+
+        # Ignore symlinks
+        if root.is_symlink() and not symlinks:
+            continue
+
+        # Convert path to absolute
+        if abs:
+            root = root.absolute()
+
+        if root.is_dir():
+            directories.append(str(root))
+        else:
+            files.append(_file_record(root, root.stat(), root.is_symlink()))
+
+    return files, directories
+
+def _list_dir(directory, recusive = True, symlinks = True, listing = None, previous = None):
+    """
+    List a single directory with os.scandir. The type of each entry comes from the cached d_type of the listing
+    so only files get a stat() call.
+
+    listing:    dict that gets directory: (mtime_ns, [file names], [subdirectory names]) for an incremental rescan
+    previous:   listing of a previous scan. A directory whose mtime didn't change isn't listed again, the names of
+                the previous scan are used instead. Its files still get a stat() call, writing to a file doesn't
+                change the mtime of its directory.
+
+    return:     ( [ {path, size, dev, ino, mtime_ns, nlink, symlink, mode}, ... ], [subdirectory, ...] )
+    """
+    files = []
+    subdirectories = []
+
+    mtime_ns = None
+    if listing is not None or previous:
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError as e:
+            print(f'Error reading files. {e}')
+            scan_errors[0] += 1
+            return files, subdirectories
+
+    known = previous.get(directory) if previous else None
+    if known and known[0] == mtime_ns:
+        for name in known[1]:
+            path = os.path.join(directory, name)
+            try:
+                st = os.lstat(path)
+                symlink = stat.S_ISLNK(st.st_mode)
+                if symlink:
+                    if not symlinks:
+                        continue
+                    st = os.stat(path)
+                # A symlink can point to a directory now without changing the listing
+                if stat.S_ISDIR(st.st_mode):
+                    continue
+
+                files.append(_file_record(Path(path), st, symlink))
+
+            except OSError as e:
+                print(f'\nError reading files. Skipping {e}')
+                scan_errors[0] += 1
+
+        if recusive:
+            subdirectories = [os.path.join(directory, name) for name in known[2]]
+        if listing is not None:
+            listing[directory] = known
+        return files, subdirectories
+
+    file_names = []
+    subdirectory_names = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    # Ignore symlinks
+                    if not symlinks and entry.is_symlink():
+                        continue
+
+                    # Scan subdirectories
+                    if entry.is_dir():
+                        subdirectory_names.append(entry.name)
+                        if recusive:
+                            subdirectories.append(entry.path)
+                        continue
+
+                    files.append(_file_record(Path(entry.path), entry.stat(), entry.is_symlink()))
+                    file_names.append(entry.name)
+
+                except OSError as e:
+                    print(f'\nError reading files. Skipping {e}')
+                    scan_errors[0] += 1
+
+    except KeyboardInterrupt: raise
+    except OSError as e:
+        print(f'Error reading files. {e}')
+        scan_errors[0] += 1
+        return files, subdirectories
+
+    if listing is not None:
+        listing[directory] = (mtime_ns, file_names, subdirectory_names)
+
+    return files, subdirectories
+
+def scan_tree(path, recusive = True, symlinks = True, abs = False, listing = None, previous = None):
+    """
+    Walk directories with os.scandir and yield the files as they are found
+
+    Directories are kept in a stack and listed one at a time, so memory only grows with the number of pending
+    directories instead of the number of files.
+
+    path:       Path to the directory or file (str) or a list of them
+    recusive:   Whether to scan recursively or not (bool)
+    symlinks:   Follow symlinks
+    abs:        Return absolute paths instead or relative ones
+    listing:    dict to record the listed directories in. See _list_dir
+    previous:   listing of a previous scan, the directories that didn't change since aren't listed again
+
+    yield:      {path, size, dev, ino, mtime_ns, nlink, symlink, mode}
+    """
+    files, stack = _scan_roots(path, symlinks, abs)
+    yield from files
+
+    while stack:
+        files, subdirectories = _list_dir(stack.pop(), recusive, symlinks, listing, previous)
+        stack.extend(subdirectories)
+        yield from files
+
+def scan_tree_parallel(path, threads, recusive = True, symlinks = True, abs = False, file_callback = None, listing = None, previous = None):
+    """
+    Walk directories with a pool of threads listing them concurrently and yield the files as they are found
+
+    Useful on network filesystems where listing a directory is bound by the latency instead of the bandwidth.
+    The threads take the directories from a shared frontier and push the subdirectories they find back into it.
+
+    path:           Path to the directory or file (str) or a list of them
+    threads:        Number of threads listing directories
+    recusive:       Whether to scan recursively or not (bool)
+    symlinks:       Follow symlinks
+    abs:            Return absolute paths instead or relative ones
+    file_callback:  List of function(filepath, item) called from the scanning threads for each file. See dir_scan
+    listing:        dict to record the listed directories in. See _list_dir
+    previous:       listing of a previous scan, the directories that didn't change since aren't listed again
+
+    yield:      {path, size, dev, ino, mtime_ns, nlink, symlink, mode}
+    """
+    files, directories = _scan_roots(path, symlinks, abs)
+
+    frontier = queue.Queue()
+    results  = queue.Queue(maxsize = threads*4)
+    stop     = threading.Event()
+    lock     = threading.Lock()
+    pending  = [len(directories)]   # directories queued or being listed
+
+    def send(batch):
+        while not stop.is_set():
+            try:
+                results.put(batch, timeout=0.1); break
+            except queue.Full:
+                pass
+
+    def worker():
+        while True:
+            directory = frontier.get()
+            if directory is None:
+                return
+
+            files, subdirectories = _list_dir(directory, recusive, symlinks, listing, previous)
+
+            try:
+                if file_callback:
+                    for item in files:
+                        for func in file_callback:
+                            r = func( str(item['path']), item )
+                            if r:
+                                item.update( r )
+            except Exception as e:
+                # Hand the exception to the consumer instead of leaving it waiting for this directory
+                files = e
+
+            with lock:
+                pending[0] += len(subdirectories)
+            for subdirectory in subdirectories:
+                frontier.put(subdirectory)
+
+            # Send the files in a bounded queue so a slow consumer doesn't make the listing grow without limit
+            send(files)
+
+            # The directory is done only after its files are sent, so the end mark can't overtake them
+            with lock:
+                pending[0] -= 1
+                last = pending[0] == 0
+
+            if last:
+                send(None)
+
+    pool = [threading.Thread(target=worker, daemon=True, name=f'scan-{i}') for i in range(threads)]
+    for thread in pool: thread.start()
+
+    for directory in directories:
+        frontier.put(directory)
+
+    try:
+        if file_callback:
+            for item in files:
+                for func in file_callback:
+                    r = func( str(item['path']), item )
+                    if r:
+                        item.update( r )
+        yield from files
+
+        while directories:
+            batch = results.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield from batch
+
+    finally:
+        stop.set()
+        for thread in pool: frontier.put(None)
+        for thread in pool: thread.join()
+
+def dir_scan(path, recusive = True, symlinks = True, abs = False, file_callback = None, progress_callback = None, threads = 1, table = None,
+             listing = None, previous = None):
     """
     Scan directory recursively
 
@@ -59,19 +341,18 @@ def dir_scan(path, recusive = True, symlinks = True, abs = False, file_callback
     recusive:   Whether to scan recursively or not (bool)
     symlinks:   Follow symlinks
     abs:        Return absolute paths instead or relative ones
-    file_callback:      List of function(filepath) to call for each file. Return type should be dict or None.
-                        If its dict the internal item will be updated with it
+    threads:    Number of threads listing directories concurrently. See scan_tree_parallel
+    table:      FileTable to add the files to, a new one is made if None
+    listing:    dict to record the listed directories in, to save in a Snapshot
+    previous:   listing of a previous scan. See _list_dir
+    file_callback:      List of function(filepath, item) to call for each file, item is its record of the scan.
+                        Return type should be dict or None. If its dict the internal item will be updated with it
     progress_callback:  List of function(current_pos, total_files_count, file_path). Gets called for each file.
                         Return value gets ignored.
 
-    return:     [ {path, size}, ... ]
+    return:     FileTable of {path, size, dev, ino, mtime_ns, nlink, symlink, mode} records
     """
     
-    if isinstance(path, list):
-        path = [Path(i) for i in path]
-    else:
-        path = [Path(path)]
-    
     if file_callback:
         if not isinstance(file_callback, list):
             file_callback = [file_callback]
@@ -80,124 +361,248 @@ def dir_scan(path, recusive = True, symlinks = True, abs = False, file_callback
         if not isinstance(progress_callback, list):
             progress_callback = [progress_callback]
 
+    if threads > 1:
+        # The file callbacks run in the scanning threads
+        walker = scan_tree_parallel(path, threads, recusive, symlinks, abs, file_callback, listing, previous)
+        file_callback = None
+    else:
+        walker = scan_tree(path, recusive, symlinks, abs, listing, previous)
 
-
-    # Create internal list
-    files = []
-    for i,v in enumerate(path):
-        files.append({
-            'path': v,
-            'size': v.stat().st_size
-            })
-    
-    i = 0
-    while i < len(files): # Scan dir recusively and its files and makes a list
+    files = table if table is not None else FileTable()
+    for item in walker:
         # Do progress callbacks
         if progress_callback:
             for func in progress_callback:
-                func(i, len(files), str(files[i]['path']) )
-                
-        # Ignore symlinks
-        if files[i]['path'].is_symlink() and not symlinks:
-            del(files[i]); continue
-        
-        # Convert path to absolute
-        if abs:
-            files[i]['path'] = files[i]['path'].absolute()
-        
-        
-        # Scan subdirectories
-        if files[i]['path'].is_dir():
-            try:
-                tmp = []
-                for item in files[i]['path'].iterdir():
-                    if item.is_dir() and not recusive:
-                        continue
-                    else:
-                        try:
-                            tmp.append({
-                                'path': item,
-                                'size': 0 if item.is_dir() else item.stat().st_size
-                                })
-                        except Exception as e:
-                            print(f'\nError reading files. Skipping {e}')
-                
-                files[i:i+1] = tmp
-            
-            except KeyboardInterrupt: raise
-            except Exception as e:
-                print(f'Error reading files. {e}')
-    
-            continue
+                func(len(files), len(files)+1, str(item['path']) )
+
+        item = files.add(item)
 
         if file_callback:
             for func in file_callback:
-                r = func( str(files[i]['path']) )
+                r = func( str(item['path']), item )
                 if r:
-                    files[i].update( r )
-
-        i += 1
+                    item.update( r )
     
     return files
 
+def inode_key(item):
+    """Return the (dev, ino) of a file, or None if it isn't known. Some systems report 0 as the inode of every file."""
+    if item.get('ino'):
+        return (item['dev'], item['ino'])
+    return None
+
+def is_regular(item):
+    """Whether a file is a regular file, FIFOs, sockets and device nodes have no content to compare. Records without a mode count as regular files"""
+    return stat.S_ISREG(item.get('mode', stat.S_IFREG))
+
+def new_group(item):
+    """
+    Return an empty group of repeated files for the hash of item: {size, hash_algorithm, files}
+
+    The rest of the keys of the item are left out. The paths of the rows of a FileTable are added as strings, like
+    the groups of a Snapshot, a Path object takes several times the memory of its string.
+    """
+    return {'size': item['size'], 'hash_algorithm': item.get('hash_algorithm'), 'files': []}
+
+def group_by_inode(files: list):
+    """
+    Keep a single path of each inode, the others point to the same data and don't need to be read again.
+
+    Symlinks are left out. The scan follows them, so they share the inode of their target, but reading one reads
+    its target again and deleting one frees no space. Files that aren't regular files are left out too.
+
+    Parameters:
+        files:      [ {path, size, dev, ino, nlink, symlink}, ... ]
+
+    Return:
+        tuple:      ( [one file per inode], { (dev, ino): [the other paths of the inode], ... } )
+                    The files of a FileTable are kept as FileRows
+    """
+    seen = set()
+    links = {}
+    output = subset_of(files)
+
+    for item in files:
+        if item.get('symlink') or not is_regular(item):
+            continue
+
+        key = inode_key(item)
+        # A file with a single link is the only path of its inode, only the others need to be remembered
+        if key is None or item.get('nlink') == 1:
+            output.append(item)
+        elif key not in seen:
+            seen.add(key)
+            output.append(item)
+        else:
+            links.setdefault(key, []).append(item)
+
+    return output, links
+
+def add_links(repeated: dict, files: list, links: dict):
+    """
+    Give the other paths of each inode the hash of the file that was read and add them to its group of repeated files.
+
+    Paths of an inode whose data isn't repeated in any other inode are hardlinks of a single file, removing
+    them doesn't free any space. They are returned apart.
+
+    Parameters:
+        repeated:   { hash: {[files], size}, ... } found between the files of group_by_inode. Updated in place, the
+                    groups that get hardlinks count them in 'linked_paths'.
+        files:      The files of group_by_inode
+        links:      The other paths of the inodes, from group_by_inode
+
+    Return:
+        dict:       { 'dev:ino': {[files], size}, ... } hardlinked files
+    """
+    linked = {}
+    for item in files:
+        others = links.get(inode_key(item))
+        if not others:
+            continue
+
+        if 'hash' in item:
+            for link in others:
+                link.update({'hash': item['hash'], 'hash_algorithm': item['hash_algorithm']})
+
+        if item.get('hash') in repeated:
+            group = repeated[item['hash']]
+            group['files'].extend([str(link['path']) for link in others])
+            group['linked_paths'] = group.get('linked_paths', 0) + len(others)
+        else:
+            dev, ino = inode_key(item)
+            linked[f'{dev}:{ino}'] = {'size': item['size'], 'hash_algorithm': item.get('hash_algorithm', 'inode'),
+                                      'files': [str(item['path'])] + [str(link['path']) for link in others]}
+
+    return linked
+
+def group_by_size(files: list, algorithm: str = HASH_ALGORITHM):
+    """
+    Drop the files that can't have a duplicate before hashing them.
+
+    A file whose size no other file shares can't be repeated, so there is no point on reading it.
+    Zero-length files are all equal, they get the digest of an empty input without being opened.
+    FIFOs, sockets and device nodes are dropped, their size says nothing about their content.
+
+    Parameters:
+        files:      [ {path, size}, ... ]
+        algorithm:  Algorithm used for the digest of the zero-length files
+
+    Return:
+        tuple:      ( [candidates], [empty files], {unique_files, unique_size, empty_files} )
+                    candidates are the files that still need to be hashed. The files of a FileTable are kept as FileRows
+    """
+    sizes = {}
+    for item in files:
+        if is_regular(item):
+            sizes[item['size']] = sizes.get(item['size'], 0) + 1
+
+    empty_digest = new_hasher(algorithm).digest().hex().lower()
+
+    candidates = subset_of(files)
+    empty_files = subset_of(files)
+    stats = {'unique_files': 0, 'unique_size': 0, 'empty_files': 0}
+
+    for item in files:
+        if not is_regular(item):
+            continue
+
+        elif item['size'] == 0:
+            item.update({'hash': empty_digest, 'hash_algorithm': algorithm})
+            empty_files.append(item)
+            stats['empty_files'] += 1
+
+        elif sizes[item['size']] < 2:
+            stats['unique_files'] += 1
+            stats['unique_size'] += item['size']
+
+        else:
+            candidates.append(item)
+
+    return candidates, empty_files, stats
+
+def _file_columns(files):
+    """
+    Return the (position, size, hash) of each file of files and a function giving the path of a position.
+
+    The rows of a FileTable or FileRows are read straight from the column arrays and their digests are given as
+    raw bytes, no FileRecord view, Path or hex string is made for the files that turn out not to be repeated.
+    """
+    if isinstance(files, FileRows):
+        table, rows = files.table, files.rows
+    elif isinstance(files, FileTable):
+        table, rows = files, range(len(files))
+    else:
+        return ((i, item['size'], item['hash']) for i, item in enumerate(files)), lambda i: files[i]['path']
+
+    sizes, digest = table.columns['size'], table.digest
+    # Digests that don't fit the buffer of the table (None after an error) are read as they are
+    values = ((i, sizes[row], digest(row) or table.get_value(row, 'hash')) for i, row in enumerate(rows))
+    return values, lambda i: table.path_str(rows[i])
+
 def check_for_repeated_files(files: list, cpu_threads: int = 1):
     """
     Check for reapeated hashes in the files list and generate a list with all the repeated files per hash
 
+    A single pass over the files with a dictionary, the position of the first file of each hash waits in it
+    until a second one shows up and the group gets created. The input doesn't need to be sorted. Files without
+    a hash (read errors) are skipped.
+
     Parameters:
-        files:      [ {path, size, hash}, ... ]
+        files:      [ {path, size, hash}, ... ] a list, FileTable or FileRows
     
     Return:
         dict::      { hash: {[files], size}, ... }
-    
-    input must be sorted by hash, aka all paths with the same hash together, one after the other, not necesarily in alphabetical order.
     """
-    # TODO: refactor this for readability, this is old code.
-
     _rep = {}
-    _count = 0
+    _first = {}     # hash: position in files of the first file with that hash
     _acc_size = 0
-    
+
     pb = MultiProgressBar(_max = len(files), _min = 0, nbars = 2, update_rate = (1/20), lenght = 35, ignore_over_under= True, charset = "#-", autostart = True)
     pb.pretext = "\033[2K\r"
-    
-    # Sort entries by hash
-    pb.set_endtext(" Sorting list...")
-    
-    files = sorted(files, key = lambda x: x['hash'])
-    
-    # Check for repeated hashes
     pb.bars_indicator = 0
-    
-    for i,v in enumerate(files):
-        pb.set(0, i)
-        # Initialize hash key if not present
-        if v['hash'] not in _rep:
-            # Skip not repeated files
-            try:
-                if ( files[i]['hash'] != files[i+1]['hash'] ): continue
-            except: continue
-                    
-            _rep[v['hash']] = dict(v)
-            del( _rep[v['hash']] ['hash'] )
-            del( _rep[v['hash']] ['path'] )
-            _rep[v['hash']]['files'] = []
-        assert( v['hash'] in _rep )
-        
-        # Check for hash colitions
-        assert ( _rep[v['hash']]['size'] == v['size'] ), 'hash colition detected'
-        
-        # Add path to the coresponding hash's paths list
-        _rep[v['hash']]['files'].append( v['path'] )
-        
-        _acc_size += _rep[v['hash']]['size']
-                
-        pb.set_endtext(" %d Files. (%s)" % ( len(_rep), human_readable_size(_acc_size) ))
-        
-    
-    # Make sure we dont have non-repeated files in the dict
-    for i,v in enumerate(_rep.keys()):
-        assert( len(_rep[v]['files']) > 1 )
+
+    # The progress bar takes a lock, only update it now and then
+    rate_limiter = timed_tigger(10)
+
+    # Creating the groups would trigger the garbage collector over and over on the millions of records
+    gc_enabled = gc.isenabled()
+    gc.disable()
+
+    try:
+        values, path_of = _file_columns(files)
+        for i, size, digest in values:
+            if not i % 4096 and rate_limiter.triggered():
+                pb.set(0, i)
+                pb.set_endtext(" %d Files. (%s)" % ( len(_rep), human_readable_size(_acc_size) ))
+
+            if digest is None:
+                continue
+
+            # Skip not repeated files, at least until another one with the same hash shows up
+            first = _first.setdefault(digest, i)
+            if first == i:
+                continue
+
+            group = _rep.get(digest)
+            if group is None:
+                group = new_group(files[first])
+                group['files'].append( path_of(first) )
+                _rep[digest] = group
+                _acc_size += group['size']
+
+            # Check for hash colitions
+            assert ( group['size'] == size ), 'hash colition detected'
+
+            # Add path to the coresponding hash's paths list
+            group['files'].append( path_of(i) )
+            _acc_size += group['size']
+
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    # The raw digests of a FileTable become the hex hashes used everywhere else
+    _rep = { (digest.hex() if isinstance(digest, bytes) else digest): group for digest, group in _rep.items() }
 
     pb.set_endtext(" %d Files. (%s)" % ( len(_rep), human_readable_size(_acc_size) ))
 
@@ -207,6 +612,223 @@ def check_for_repeated_files(files: list, cpu_threads: int = 1):
     return _rep
 
 
+class IncrementalGrouper():
+    """
+    Group hashed files by hash as they come. The groups with more than one file are confirmed repeated files.
+
+    Builds the same { hash: {[files], size}, ... } structure as check_for_repeated_files without needing the
+    whole list first.
+    """
+
+    def __init__(self, key = None):
+        """
+        Parameters:
+            key:        function(item) returning the key to group by, the hash by default
+        """
+        self.key = key or (lambda item: item['hash'])
+        self.groups = {}
+        self.repeated = 0
+
+    def add(self, item):
+        """
+        Add a hashed item
+
+        Parameters:
+            item:       {path, size, hash}
+
+        Return:
+            dict:       The group of the item if it has more than one file, None otherwise
+        """
+        if item.get('hash') is None:
+            return None
+
+        key = self.key(item)
+        group = self.groups.get(key)
+        if group is None:
+            group = new_group(item)
+            self.groups[key] = group
+
+        # Check for hash colitions
+        assert ( group['size'] == item['size'] ), 'hash colition detected'
+
+        group['files'].append( str(item['path']) )
+
+        if len(group['files']) == 2:
+            self.repeated += 1
+
+        return group if len(group['files']) > 1 else None
+
+    def result(self):
+        """Return the repeated files like check_for_repeated_files: { hash: {[files], size}, ... }"""
+        return { k: v for k, v in self.groups.items() if len(v['files']) > 1 }
+
+def stream_files(paths, cpu_threads, algorithm = HASH_ALGORITHM, scan_threads = 1, cache = None, batch_size = 64,
+                 file_callback = None, progress_callback = None, group_callback = None, confirm_algorithm = None,
+                 listing = None, previous = None, **read_options):
+    """
+    Scan, hash and group the files at the same time
+
+    The scanned files go to a HashStream as soon as another file with the same size shows up, and the hashed
+    files go to an IncrementalGrouper as soon as they come back. Zero-length files are grouped without reading them.
+    Only the first path of each inode is read, the others are added to its group at the end. Symlinks are left
+    out. See add_links and group_by_inode
+    Files aren't ordered by disk position in this mode.
+
+    Parameters:
+        paths:              Directories to scan
+        scan_threads:       Threads listing directories. See dir_scan
+        cache:              HashCache to look up the digests in before queuing the files
+        batch_size:         Number of files sent to the hashers at once
+        file_callback:      List of function(filepath, item) to call for each file. See dir_scan
+        progress_callback:  function(scanned_files, hashed_files, repeated_groups). Gets called for each file.
+        group_callback:     function(hash, group). Gets called each time a file is added to a repeated group.
+        confirm_algorithm:  Cryptographic algorithm the repeated groups found with a fast algorithm get hashed again with
+                            once the scan is over, or None. group_callback only sees the groups of the first algorithm.
+        listing:            dict to record the listed directories in. See dir_scan
+        previous:           listing of a previous scan. See dir_scan
+        read_options:       chunk_size, mmap_min_size and profile_dir of QueuedFileHasher_mp
+
+    Return:
+        tuple:      ( [all files], { hash: {[files], size}, ... }, { 'dev:ino': {[files], size}, ... } hardlinked files,
+                      {total_size, unique_files, unique_size, empty_files, linked_files, hashed_files, cached_files, read_size, confirmed_files,
+                       workers} ) workers are the get_worker_stats of the hashers
+    """
+    if file_callback and not isinstance(file_callback, list):
+        file_callback = [file_callback]
+
+    # Zero-length files don't need a confirmation, give them the digest of the last tier
+    empty_algorithm = confirm_algorithm or algorithm
+    empty_digest = new_hasher(empty_algorithm).digest().hex().lower()
+
+    all_files = FileTable(max([new_hasher(name).digest_size for name in (algorithm, confirm_algorithm) if name]))
+    sizes = {}      # size: first file with that size, True once it was queued with the next one
+    inodes = {}     # (dev, ino): first path of the inode
+    links = {}      # (dev, ino): the other paths
+    batch = []
+    to_store = []   # hashed files to add to the cache
+    stats = {'total_size': 0, 'unique_files': 0, 'unique_size': 0, 'empty_files': 0, 'linked_files': 0, 'hashed_files': 0, 'cached_files': 0,
+             'read_size': 0, 'confirmed_files': 0}
+
+    hasher = HashStream(cpu_threads, algorithm, **read_options)
+    # Files of different sizes can share a fast digest
+    grouper = IncrementalGrouper(key = (lambda item: (item['size'], item['hash'])) if confirm_algorithm else None)
+
+    def group(items, hashed = True):
+        if hashed:
+            stats['hashed_files'] += len(items)
+            if cache is not None:
+                to_store.extend([item for item in items if not item.get('cached')])
+
+        for item in items:
+            repeated = grouper.add(item)
+            if repeated and group_callback:
+                group_callback(item['hash'], repeated)
+
+    def flush():
+        nonlocal batch
+        if cache is not None:
+            batch, hits = cache.lookup(batch, algorithm)
+            stats['cached_files'] += len(hits)
+            group(hits)
+        hasher.submit(batch)
+        batch = []
+
+    if scan_threads > 1:
+        walker = scan_tree_parallel(paths, scan_threads, symlinks = True, abs = True, file_callback = file_callback,
+                                    listing = listing, previous = previous)
+        file_callback = None
+    else:
+        walker = scan_tree(paths, symlinks = True, abs = True, listing = listing, previous = previous)
+
+    try:
+        for item in walker:
+            if file_callback:
+                for func in file_callback:
+                    r = func( str(item['path']), item )
+                    if r:
+                        item.update( r )
+
+            item = all_files.add(item)
+            stats['total_size'] += item['size']
+
+            key = inode_key(item)
+
+            # Symlinks share the inode of their target, FIFOs, sockets and device nodes have no content to compare.
+            # They are never read nor grouped
+            if item['symlink'] or not is_regular(item):
+                pass
+
+            # Other paths of an inode already seen, the first one gets recorded
+            elif key is not None and inodes.setdefault(key, item) is not item:
+                links.setdefault(key, []).append(item)
+                stats['linked_files'] += 1
+
+            # Zero-length files are all equal
+            elif item['size'] == 0:
+                item.update({'hash': empty_digest, 'hash_algorithm': empty_algorithm})
+                stats['empty_files'] += 1
+                group([item], hashed = False)
+
+            # Queue the files once their size isn't unique
+            else:
+                first = sizes.get(item['size'])
+                if first is None:
+                    sizes[item['size']] = item
+                else:
+                    if first is not True:
+                        batch.append(first)
+                        sizes[item['size']] = True
+                    batch.append(item)
+
+            if len(batch) >= batch_size:
+                flush()
+
+            group(hasher.results())
+
+            if progress_callback:
+                progress_callback(len(all_files), stats['hashed_files'], grouper.repeated)
+
+        flush()
+        hasher.close()
+
+        while hasher.pending:
+            group(hasher.results(timeout = 0.1))
+            if progress_callback:
+                progress_callback(len(all_files), stats['hashed_files'], grouper.repeated)
+
+    except BaseException:
+        for worker in hasher.workers: worker.stop()
+        raise
+
+    stats['read_size'] = hasher.read_bytes
+    hasher.join()
+    stats['workers'] = hasher.worker_stats()
+
+    if cache is not None:
+        cache.store(to_store, algorithm)
+
+    for first in sizes.values():
+        if first is not True:
+            stats['unique_files'] += 1
+            stats['unique_size'] += first['size']
+
+    repeated = grouper.result()
+
+    # Digests of a fast algorithm can collide, hash the repeated groups again and group them from scratch
+    if confirm_algorithm:
+        candidates = [item for item in all_files if (item['size'], item.get('hash')) in repeated]
+        confirmed = confirm_collisions(candidates, cpu_threads, confirm_algorithm, cache, **read_options)
+        stats['confirmed_files'] = len(confirmed)
+
+        grouper = IncrementalGrouper()
+        for item in candidates:
+            grouper.add(item)
+        repeated = grouper.result()
+
+    linked = add_links(repeated, [inodes[key] for key in links], links)
+
+    return all_files, repeated, linked, stats
+
 def sort_repeated_files_list(hashes_list):
     """
     Sort repeated files by shortest path first, shortest name second.
@@ -226,30 +848,66 @@ def sort_repeated_files_list(hashes_list):
 
     return hashes_list
 
+def _links_metadata(all_files, groups):
+    """
+    Get the metadata recorded by the scan for the paths of the repeated files
+
+    Parameters:
+        all_files:  [ {path, dev, nlink, symlink}, ... ]
+        groups:     Lists of [{hash: {[files]}}, ...]
+
+    Return:
+        dict:       { path string: (dev, nlink, symlink), ... } only for the paths in the groups, None for the
+                    ones the scan didn't record
+    """
+    # Keyed by the path strings of the groups, the strings made while going through all_files aren't kept
+    metadata = dict.fromkeys(str(file) for groups_list in groups for item in groups_list for file in item[tuple(item.keys())[0]]['files'])
+
+    for item in all_files:
+        path = str(item['path'])
+        if path in metadata and 'nlink' in item:
+            metadata[path] = (item['dev'], item['nlink'], bool(item['symlink']))
+
+    return metadata
+
 def write_batch_file(
     repeated_files: list, 
     all_files: list, 
     output_directory: str = '.',
     batch_script_name: str = 'list.sh',
     relative_path: str = '.',
-    link_repeated_files: bool = False
+    link_repeated_files: bool = False,
+    linked_files: list = None
 ):
     """
     Write a batch script to remove duplicate files based on a given list of repeated files.
+
+    The links and devices of the files come from the values recorded by the scan, the files are only stat'ed
+    if all_files doesn't have them. The script is written group by group through a buffered file.
     
     Parameters:
         repeated_files ([{hash: {path, size, [files]}}, ...]): List of tuples containing file repetitions.
-        all_files ([path, ...]):    List of all files in the current directory.
+        all_files ([{path, dev, nlink, symlink}, ...]): List of all files in the current directory.
         output_directory (str):     Path to the output directory where the batch script will be saved to.
         batch_script_name (str):    Name of the batch script file (default: 'list.sh').
         relative_path (str):        Relative path from the current directory.
         link_repeated_files (bool): Replace files with hardlinks/symlinks instead of deleting
+        linked_files ([{'dev:ino': {size, [files]}}, ...]): Hardlinks of a single file, listed apart as comments
     
     Returns:
         None
     """
     # Note \\?\C:\
 
+    metadata = _links_metadata(all_files, [repeated_files])
+
+    def links(file):
+        """(dev, nlink, symlink) of a file"""
+        if metadata.get(str(file)) is None:
+            st = Path(file).stat()
+            metadata[str(file)] = (st.st_dev, st.st_nlink, Path(file).is_symlink())
+        return metadata[str(file)]
+
     # Header for the batch script
     header = ''
 
@@ -279,57 +937,169 @@ def write_batch_file(
     header += f'cd "{Path(output_directory).absolute()}"\n\n' 
     header += f"{comment_preffix} ---- Repeated files list - {all_files_num} files / {repeated_files_num} repeated ({human_readable_size(repeated_files_num_size)})---- \n\n"
 
-    # Create the main script for removing duplicate files
-    main_script = ''
-    for item in repeated_files:
-        k = tuple(item.keys())[0]
-        filename        = Path(item[k]["files"][0])
-        
+    with open(batch_script_name, 'w', buffering=1024*1024) as f:
+        f.write(escape_string_in_utf8(header))
 
-        # Add comment and commands to remove duplicate file
-        ref_is_linked = ''
-        if filename.is_symlink():
-            ref_is_linked = '(symlink)'
-        elif filename.stat().st_nlink > 1:
-            ref_is_linked = f'(hardlink, {filename.stat().st_nlink})'
+        # Write the commands for removing duplicate files, a group at a time
+        for item in repeated_files:
+            k = tuple(item.keys())[0]
+            filename        = Path(item[k]["files"][0])
+            ref_dev, ref_nlink, ref_symlink = links(filename)
+            lines = []
 
-        main_script += f'{comment_preffix} {item[k]["hash_algorithm"]}: {k} - "{filename.name}" - {human_readable_size(item[k]["size"])} {ref_is_linked} - {len(item[k]["files"][1:])} repeated files\n' 
-        
-        main_script += f'{comment_preffix} {remove_cmd.format(item[k]["files"][0])}\n'
-
-        # Add commands to remove additional duplicates for each repeated file
-        for file in item[k]["files"][1:]:
-            # Add notice if the file is a link
-            if Path(file).is_symlink():
-                main_script += f'{comment_preffix} The following file is a symlink\n'
-            elif Path(file).stat().st_nlink > 1:
-                main_script += f'{comment_preffix} The following file is a hardlink ({Path(file).stat().st_nlink})\n'
-
-            main_script += f'{remove_cmd.format(file)}\n'
-            
-            # If link_repeated_files add a hard link after deleting the repeated file. Use a symlink instead of its on a different drive.
-            if link_repeated_files:
-                ref_file_dev_id = filename.stat().st_dev
-                file_dev_id     = Path(file).stat().st_dev
-
-                link_cmd = hardlink_cmd if ref_file_dev_id == file_dev_id else symlink_cmd
-
-                if os.name == 'nt': # Link, target
-                    main_script += f'{link_cmd.format(file, item[k]["files"][0])}\n'
-                else: # Target, Link
-                    main_script += f'{link_cmd.format(item[k]["files"][0], file)}\n'
+            # Add comment and commands to remove duplicate file
+            ref_is_linked = ''
+            if ref_symlink:
+                ref_is_linked = '(symlink)'
+            elif ref_nlink > 1:
+                ref_is_linked = f'(hardlink, {ref_nlink})'
 
-        
-        main_script += '\n\n'
+            # Groups found comparing the files have no digest
+            digest = 'compared' if item[k]["hash_algorithm"] == 'compare' else f'{item[k]["hash_algorithm"]}: {k}'
 
-    # Write the batch script to a file
-    with open(batch_script_name, 'w') as f:
-        f.write(escape_string_in_utf8(header + main_script))
+            lines.append(f'{comment_preffix} {digest} - "{filename.name}" - {human_readable_size(item[k]["size"])} {ref_is_linked} - {len(item[k]["files"][1:])} repeated files')
+            lines.append(f'{comment_preffix} {remove_cmd.format(item[k]["files"][0])}')
+
+            # Add commands to remove additional duplicates for each repeated file
+            for file in item[k]["files"][1:]:
+                file_dev_id, nlink, symlink = links(file)
+
+                # Add notice if the file is a link
+                if symlink:
+                    lines.append(f'{comment_preffix} The following file is a symlink')
+                elif nlink > 1:
+                    lines.append(f'{comment_preffix} The following file is a hardlink ({nlink})')
+
+                lines.append(remove_cmd.format(file))
+                
+                # If link_repeated_files add a hard link after deleting the repeated file. Use a symlink instead of its on a different drive.
+                if link_repeated_files:
+                    link_cmd = hardlink_cmd if ref_dev == file_dev_id else symlink_cmd
+
+                    if os.name == 'nt': # Link, target
+                        lines.append(link_cmd.format(file, item[k]["files"][0]))
+                    else: # Target, Link
+                        lines.append(link_cmd.format(item[k]["files"][0], file))
+
+            f.write(escape_string_in_utf8('\n'.join(lines) + '\n\n\n'))
+
+        # Paths of a single inode, deleting them doesn't free any space
+        if linked_files:
+            f.write(f"{comment_preffix} ---- Hardlinked files - {len(linked_files)} files with {sum([len(item[tuple(item.keys())[0]]['files']) for item in linked_files])} paths, deleting them frees no space ---- \n\n")
+
+            for item in linked_files:
+                k = tuple(item.keys())[0]
+                lines = [f'{comment_preffix} inode {k} - "{Path(item[k]["files"][0]).name}" - {human_readable_size(item[k]["size"])} - {len(item[k]["files"])} paths']
+                lines.extend([f'{comment_preffix}   "{file}"' for file in item[k]["files"]])
+                f.write(escape_string_in_utf8('\n'.join(lines) + '\n\n'))
+
+def write_report(
+    path: str,
+    repeated_files: list,
+    linked_files: list = None,
+    report_format: str = 'jsonl'
+):
+    """
+    Write the repeated files as a report with one group per line, for other programs to read.
+
+    Each group is written as soon as it is formatted, the report is never held in memory.
+
+    Parameters:
+        path (str):                 Path to the report file
+        repeated_files ([{hash: {size, [files]}}, ...]): Groups of sort_repeated_files_list
+        linked_files ([{'dev:ino': {size, [files]}}, ...]): Hardlinks of a single file, reported with 0 reclaimable bytes
+        report_format (str):        'jsonl' for a JSON object per line or 'csv'
+
+    Line fields:
+        type, hash, hash_algorithm, size, count, reclaimable, paths
+        type is 'repeated' or 'hardlinks'. hash is null for the groups found comparing the files, their
+        hash_algorithm is 'compare'. reclaimable is the space deleting all the paths but the first frees,
+        paths that are hardlinks of another path of the group don't count. A CSV line has the paths as its last columns.
+        A JSONL line is always valid UTF-8. When a path of the group isn't, it is written with replacement characters
+        and the line gets a paths_bytes field, the hex of the bytes of each such path on disk and null for the others.
+        A CSV report writes those paths with their bytes as they are on disk, so it is only UTF-8 if all the paths are.
+    """
+    fields = ('type', 'hash', 'hash_algorithm', 'size', 'count', 'reclaimable')
+
+    def groups():
+        for kind, groups_list in (('repeated', repeated_files), ('hardlinks', linked_files or [])):
+            for item in groups_list:
+                k = tuple(item.keys())[0]
+                group = item[k]
+                copies = len(group['files']) - 1 - group.get('linked_paths', 0) if kind == 'repeated' else 0
+
+                yield {
+                    'type':             kind,
+                    'hash':             None if group.get('hash_algorithm') == 'compare' else k,
+                    'hash_algorithm':   group.get('hash_algorithm'),
+                    'size':             group['size'],
+                    'count':            len(group['files']),
+                    'reclaimable':      group['size'] * max(copies, 0),
+                    'paths':            [str(file) for file in group['files']],
+                    }
+
+    def utf8_bytes(file):
+        """Hex of the bytes of a path that isn't valid UTF-8, the scan decodes them with surrogate escapes. None for the others"""
+        try:
+            file.encode('utf-8')
+        except UnicodeEncodeError:
+            return os.fsencode(file).hex()
+        return None
+
+    if report_format == 'csv':
+        # Paths that aren't valid UTF-8 are written with their bytes as they are on disk
+        with open(path, 'w', encoding='utf-8', errors='surrogateescape', newline='', buffering=1024*1024) as f:
+            writer = csv.writer(f)
+            writer.writerow(fields + ('paths',))
+            for line in groups():
+                writer.writerow([line[field] for field in fields] + line['paths'])
+    else:
+        with open(path, 'w', encoding='utf-8', newline='', buffering=1024*1024) as f:
+            for line in groups():
+                raw = [utf8_bytes(file) for file in line['paths']]
+                if any(raw):
+                    line['paths'] = [os.fsencode(file).decode('utf-8', errors='replace') for file in line['paths']]
+                    line['paths_bytes'] = raw
+                f.write(json.dumps(line, ensure_ascii=False) + '\n')
 
-        
 # =============================================================================
 # ---- Misc -------------------------------------------------------------------
 
+def print_snapshot_changes(snapshot, repeated, listing, previous, max_lines = 20):
+    """
+    Show how the repeated files changed since the run saved in a snapshot
+
+    Parameters:
+        snapshot:   Snapshot of the previous run
+        repeated:   { hash: {[files], size}, ... } of this run
+        listing:    Directories listed in this run
+        previous:   Directories of the previous run
+        max_lines:  Maximum number of groups listed
+    """
+    if not previous:
+        print ('No previous snapshot, saving this run to %s' % snapshot.path)
+        return
+
+    reused = sum([1 for directory, entry in listing.items() if directory in previous and previous[directory][0] == entry[0]])
+    print ('Reused the listing of %d of %d directories from the snapshot' % (reused, len(listing)))
+
+    diff = diff_groups(snapshot.load_groups(), repeated)
+    print ('Since the previous run: %d new groups of repeated files, %d gone, %d changed' % (
+        len(diff['added']), len(diff['removed']), len(diff['changed'])))
+
+    lines = []
+    for digest in diff['added']:
+        lines.append('  + %s (%d files) %s' % (digest, len(repeated[digest]['files']), repeated[digest]['files'][0]))
+    for digest in diff['removed']:
+        lines.append('  - %s' % digest)
+    for digest, change in diff['changed'].items():
+        lines.append('  ~ %s +%d -%d files' % (digest, len(change['added']), len(change['removed'])))
+
+    for line in lines[:max_lines]:
+        print (line)
+    if len(lines) > max_lines:
+        print ('  ... %d more' % (len(lines) - max_lines))
+
 def sigint_handler(signum, frame):
     print('\nInterrupted')
     # os.kill(os.getpid(), signal.SIGKILL)
@@ -340,7 +1110,8 @@ def sigint_handler(signum, frame):
     for proc in multiprocessing.active_children():
         proc.join(timeout=0.33)
         print(proc.name, 'joined')
-        os.kill(proc.pid, signal.SIGTERM)
+        if proc.is_alive():
+            os.kill(proc.pid, signal.SIGTERM)
     os.kill(os.getpid(), signal.SIGTERM)
     
     exit()
@@ -348,6 +1119,30 @@ def sigint_handler(signum, frame):
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Finds repeated files and makes a batch script to delete them')
     parser.add_argument('path', type=str, help='path to scan.',  nargs='+', default=None)
+    parser.add_argument('--algorithm', type=str, choices=algorithms_available(), metavar='ALGORITHM',
+                        help=f'hash algorithm: blake2b, blake2s, sha256, sha1 (default), ... or a fast one: {", ".join(FAST_ALGORITHMS.keys())}.',
+                        default=HASH_ALGORITHM)
+    parser.add_argument('--confirm-algorithm', type=str, choices=algorithms_available(), metavar='ALGORITHM',
+                        help='cryptographic algorithm to hash again the files whose --algorithm digest collides.', default=None)
+    parser.add_argument('--compare-max-files', type=int, help='compare instead of hash groups of files of the same size with up to this many files, 0 to always hash.', default=COMPARE_MAX_FILES)
+    parser.add_argument('--compare-min-size', type=int, help='only compare files of at least this size in MiB.', default=COMPARE_MIN_SIZE//(1024*1024))
+    parser.add_argument('--report', type=str, help='also write the repeated files to this file, one group per line.', default=None)
+    parser.add_argument('--report-format', type=str, choices=['jsonl', 'csv'], help='format of --report, taken from its extension by default.', default=None)
+    parser.add_argument('--scan-threads', type=int, help='number of threads listing directories, useful on network filesystems.', default=1)
+    parser.add_argument('--stream', action='store_true', help='hash the files while scanning instead of after.')
+    parser.add_argument('--chunk-size', type=int, help='size of the reads when hashing in KiB.', default=1024)
+    parser.add_argument('--mmap-min-size', type=int, help='hash files of at least this size in MiB from a memory map, 0 to always read.', default=0)
+    parser.add_argument('--cache', type=str, help='sqlite file to keep the digests in between runs.', default=None)
+    parser.add_argument('--cache-max-entries', type=int, help='maximum number of entries kept in the cache, 0 for no limit.', default=0)
+    parser.add_argument('--cache-clear', action='store_true', help='remove all the entries from the cache before scanning.')
+    parser.add_argument('--metrics', type=str, help='write the timings and counters of each phase to this JSON file.', default=None)
+    parser.add_argument('--metrics-prometheus', type=str, help='write the metrics to this file for the Prometheus node_exporter textfile collector (*.prom).', default=None)
+    parser.add_argument('--profile', type=str, metavar='DIRECTORY', help='profile the run with cProfile, hashing processes included, '
+                        'and write the stats of each process and a merged report to this directory.', default=None)
+    parser.add_argument('--daemon', type=str, metavar='SOCKET', help='after the scan keep watching the directories with inotify (Linux only) '
+                        'and answer "groups" and "stats" queries on this unix socket.', default=None)
+    parser.add_argument('--snapshot', type=str, help='sqlite file to keep the directories and repeated files in between runs. Unchanged directories aren\'t listed again, '
+                        'only new or modified files get hashed (it is also the --cache if none is given) and the changes since the previous run are shown.', default=None)
     
     try:
         args = parser.parse_args()
@@ -363,69 +1158,288 @@ def parse_arguments():
 
     return args
 
-def main(argv):
-    
-    start_time = time.time()
+def read_options(args):
+    """Return the options for reading files passed to the hashers"""
+    return { 'chunk_size': args.chunk_size*1024, 'mmap_min_size': args.mmap_min_size*1024*1024, 'profile_dir': args.profile }
+
+def run_phases(paths, args, cache = None, listing = None, previous = None, metrics = None):
+    """
+    Find the repeated files scanning, hashing and checking one phase after the other
+
+    listing and previous are passed to dir_scan for an incremental rescan. Each phase is recorded in metrics.
+
+    Return:
+        tuple:      ( [all files], { hash: {[files], size}, ... }, { 'dev:ino': {[files], size}, ... } hardlinked files )
+    """
+    if metrics is None:
+        metrics = Metrics()
 
-    paths = [Path(i) for i in args.path]
-    for path in paths:
-        if not path.is_dir():
-            print( f'"{path}" is not a directory')
-            return 2
-        
-    if (len(paths) > 1): use_absolute_paths = True
-    
     # ------------------ Scan ----------------------
         
-    files = []
-    _total_size = 0
-    for i, path in enumerate(paths):
-        print (f'Scanning: {path}')
-        tmp = dir_scan(path, symlinks = True, abs = True, file_callback=get_file_pos, progress_callback = lambda x,y,z: print(f'\r{x}/{y}', end=''))
-        
-        for f in tmp: _total_size += f['size']
-        
-        files.extend(tmp)
-    
-    print ('\r', end='')
+    rate_limiter = timed_tigger(progress_rate())
+    def progress(scanned, total, path):
+        if rate_limiter.triggered():
+            print_progress(f'{scanned}/{total}')
+
+    files = FileTable(max([new_hasher(name).digest_size for name in (args.algorithm, args.confirm_algorithm) if name]))
+    with metrics.phase('scan') as phase:
+        errors = scan_errors[0]
+        for i, path in enumerate(paths):
+            print (f'Scanning: {path}')
+            dir_scan(path, symlinks = True, abs = True, file_callback=get_file_pos, progress_callback = progress,
+                     threads = args.scan_threads, table = files, listing = listing, previous = previous)
+
+        _total_size = sum(files.columns['size'])
+        phase.update({'files': len(files), 'bytes': _total_size, 'errors': scan_errors[0] - errors})
+
+    if is_tty(): print ('\r', end='')
     print ('Found %d files (%s)' % (len(files), human_readable_size(_total_size))  )
 
     # Sort files by LCN/inode number to improve sequential reading on HDDs
-    files = sorted(files, key= lambda x: (x['pos'], x['path']))
+    with metrics.phase('sort', len(files)):
+        files.sort('pos', 'path')
+    all_files = files
+
+    # ------------------ Inode ---------------------
+    # Hardlinks of a file already read get its hash at the end
+    with metrics.phase('inode', len(files)):
+        files, links = group_by_inode(files)
+    inode_files = files
+
+    if links:
+        print ('Skipped %d hardlinks of %d files' % (sum([len(others) for others in links.values()]), len(links)))
+
+    # ------------------ Size ----------------------
+    # Only files sharing their size with another one can be repeated
+    with metrics.phase('size', len(files)):
+        files, empty_files, size_stats = group_by_size(files, args.confirm_algorithm or args.algorithm)
+
+    print ('Skipped %d files with an unique size (%s not read), %d empty files' % (
+        size_stats['unique_files'], human_readable_size(size_stats['unique_size']), size_stats['empty_files'] ))
+
+    # ------------------ Compare --------------------
+    # Small groups of big files are compared directly. Comparisons can't be cached, with a cache everything gets hashed.
+    to_compare, files = split_for_compare(files, args.compare_max_files if cache is None else 0, args.compare_min_size*1024*1024)
+
+    compared = []
+    if to_compare:
+        print ('Comparing files')
+        with metrics.phase('compare') as phase:
+            identical, compare_read = compare_groups(to_compare, cpu_threads, **read_options(args))
+            compared = [item for group in identical for item in group]
+            phase.update({'files': sum([len(group) for group in to_compare]), 'bytes': compare_read,
+                          'errors': sum([1 for group in to_compare for item in group if item.get('error')])})
+
+        compare_size = sum([item['size'] for group in to_compare for item in group])
+        print ('compare stage: %d groups, %d files, %d identical, %s read, %s not read' % (len(to_compare),
+            sum([len(group) for group in to_compare]), len(compared), human_readable_size(compare_read),
+            human_readable_size(compare_size - compare_read) ))
 
     # ------------------ Hash -----------------------
     print ('Calculating checksum')
 
-    old = files[:]
-    files = hash_files(files, cpu_threads); print()
-    files = sorted(files, key= lambda x: (x['pos'], x['path']))
+    # Sizes before hashing by row, a copy of the column
+    old = all_files.columns['size'][:]
+    with metrics.phase('hash') as phase:
+        to_hash = files
+        files, stage_stats = hash_files_staged(files, cpu_threads, args.algorithm, SAMPLE_SIZE, cache, args.confirm_algorithm, **read_options(args)); print()
+        # The table is sorted by (pos, path), so are its rows
+        files.sort(key = lambda item: item.row)
+
+        phase.update({'files': len(to_hash), 'errors': sum([1 for item in to_hash if item.get('error')]),
+                      'bytes': sum([stage['read_size'] for stage in stage_stats.values()])})
+        phase['workers'] += [dict(worker, stage = name) for name, stage in stage_stats.items() for worker in stage['workers']]
 
     # Redundant checks because multiprocessing is super buggy
-    assert(len(old) == len(files))
-    for i in range(len(files)):
-        assert(files[i]['path'] == old[i]['path'])
-        assert(files[i]['size'] == old[i]['size'])
-        assert('hash' in files[i])
+    assert(len(files) == len(to_hash) - stage_stats['sample']['dropped_files'] - stage_stats['confirm']['dropped_files'])
+    for item in files:
+        assert(old[item.row] == item['size'])
+        assert('hash' in item)
+    del old, to_hash
+
+    for stage in ('sample', 'full', 'confirm'):
+        if stage == 'confirm' and not args.confirm_algorithm:
+            continue
+
+        print ('%-7s stage: %d files, %d cached, %d dropped, %s read, %s not read' % ( stage, stage_stats[stage]['files'],
+            stage_stats[stage]['cached_files'], stage_stats[stage]['dropped_files'],
+            human_readable_size(stage_stats[stage]['read_size']), human_readable_size(stage_stats[stage]['avoided_size']) ))
+
+        utilisation = [worker['utilisation'] for worker in stage_stats[stage]['workers']]
+        if utilisation:
+            print ('%-7s stage: %d workers, %.0f%% - %.0f%% busy' % (stage, len(utilisation), min(utilisation)*100, max(utilisation)*100))
+
+    files.extend(compared)
+    files.extend(empty_files)
 
     # ----------------- Check ----------------------
     print ('Checking for repeated files')
-    files = sorted(files, key= lambda x: x['hash'])
 
-    repeated_files = check_for_repeated_files(files); print()
+    with metrics.phase('check', len(files)):
+        repeated_files = check_for_repeated_files(files); print()
     # dump_to_json("dump_rep.txt", repeated_files)
+
+    with metrics.phase('links', len(links)):
+        linked_files = add_links(repeated_files, inode_files, links)
+
+    return all_files, repeated_files, linked_files
+
+def run_stream(paths, args, cache = None, listing = None, previous = None, metrics = None):
+    """
+    Find the repeated files with the scan, hash and check phases running at the same time. See stream_files
+
+    listing and previous are passed to stream_files for an incremental rescan. The phases can't be told apart,
+    they are recorded in metrics as a single 'stream' phase.
+
+    Return:
+        tuple:      ( [all files], { hash: {[files], size}, ... }, { 'dev:ino': {[files], size}, ... } hardlinked files )
+    """
+    print ('Scanning and calculating checksum: %s' % ', '.join([str(path) for path in paths]))
+
+    rate_limiter = timed_tigger(progress_rate())
+    def progress(scanned, hashed, repeated):
+        if rate_limiter.triggered():
+            print_progress(f'Scanned {scanned} files, hashed {hashed}, {repeated} repeated')
+
+    if metrics is None:
+        metrics = Metrics()
+
+    with metrics.phase('stream') as phase:
+        errors = scan_errors[0]
+        all_files, repeated_files, linked_files, stats = stream_files(paths, cpu_threads, args.algorithm, args.scan_threads, cache,
+                                                        progress_callback = progress,
+                                                        confirm_algorithm = args.confirm_algorithm, listing = listing, previous = previous,
+                                                        **read_options(args))
+        phase.update({'files': len(all_files), 'bytes': stats['read_size'],
+                      'errors': scan_errors[0] - errors + sum([worker['errors'] for worker in stats['workers']])})
+        phase['workers'] += [dict(worker, stage = 'stream') for worker in stats['workers']]
+
+    if is_tty(): print ('\r', end='')
+    print ('Found %d files (%s)' % (len(all_files), human_readable_size(stats['total_size'])) )
+    print ('Skipped %d files with an unique size (%s not read), %d empty files, %d hardlinks' % (
+        stats['unique_files'], human_readable_size(stats['unique_size']), stats['empty_files'], stats['linked_files'] ))
+    print ('Hashed %d files (%s read), %d cached' % (stats['hashed_files'], human_readable_size(stats['read_size']), stats['cached_files']))
+    if args.confirm_algorithm:
+        print ('Confirmed %d files with %s' % (stats['confirmed_files'], args.confirm_algorithm))
+
+    return all_files, repeated_files, linked_files
+
+def run_daemon(paths, args, cache = None, snapshot = None):
+    """
+    Scan the directories once and then keep their repeated files up to date with inotify. See WatchDaemon
+
+    Fast algorithms aren't confirmed in this mode, the files are hashed with --confirm-algorithm if it is given.
+    The initial scan is saved to the snapshot, if any, like a normal run. The cache is closed once the daemon stops.
+    """
+    algorithm = args.confirm_algorithm or args.algorithm
+
+    print ('Scanning and calculating checksum: %s' % ', '.join([str(path) for path in paths]))
+
+    listing = {}
+    previous = snapshot.load_listing() if snapshot is not None else None
+    all_files, repeated_files, linked_files, stats = stream_files(paths, cpu_threads, algorithm, args.scan_threads, cache,
+                                                                  listing = listing, previous = previous, **read_options(args))
+    print ('Found %d files (%s), %d repeated' % (len(all_files), human_readable_size(stats['total_size']), len(repeated_files)))
+
+    if snapshot is not None:
+        print_snapshot_changes(snapshot, repeated_files, listing, previous)
+        snapshot.save_listing(listing)
+        snapshot.save_groups(repeated_files)
+        snapshot.close()
+
+    daemon = WatchDaemon(paths, args.daemon, cpu_threads, algorithm,
+                         lambda path, listing: scan_tree(path, symlinks = True, abs = True, listing = listing),
+                         cache, **read_options(args))
+    daemon.load(all_files, listing)
+    del all_files
+
+    try:
+        daemon.run()
+    finally:
+        if cache is not None:
+            cache.close()
+
+def main(argv):
     
-    repeated_files = sort_repeated_files_list(repeated_files)
+    start_time = time.time()
+
+    paths = [Path(i) for i in args.path]
+    for path in paths:
+        if not path.is_dir():
+            print( f'"{path}" is not a directory')
+            return 2
+        
+    if (len(paths) > 1): use_absolute_paths = True
+
+    if args.algorithm in FAST_ALGORITHMS and not args.confirm_algorithm:
+        print( f'"{args.algorithm}" is not a cryptographic algorithm, its digests can collide. Use it with --confirm-algorithm')
+        return 2
+    if args.confirm_algorithm in FAST_ALGORITHMS:
+        print( f'"{args.confirm_algorithm}" can not confirm collisions, use a cryptographic algorithm')
+        return 2
+    if args.daemon and not sys.platform.startswith('linux'):
+        print( '--daemon needs inotify, it only works on Linux')
+        return 2
+
+    snapshot = None
+    listing = previous = None
+    if args.snapshot:
+        snapshot = Snapshot(args.snapshot)
+
+    cache = None
+    if args.cache or snapshot is not None:
+        cache = HashCache(args.cache or args.snapshot, args.cache_max_entries)
+        if args.cache_clear: cache.clear()
+
+    if args.daemon:
+        return run_daemon(paths, args, cache, snapshot)
+
+    if snapshot is not None:
+        listing = {}
+        previous = snapshot.load_listing()
+
+    metrics = Metrics()
+
+    if args.stream:
+        all_files, repeated_files, linked_files = run_stream(paths, args, cache, listing, previous, metrics)
+    else:
+        all_files, repeated_files, linked_files = run_phases(paths, args, cache, listing, previous, metrics)
+
+    if cache is not None:
+        cache.close()
+
+    if snapshot is not None:
+        print_snapshot_changes(snapshot, repeated_files, listing, previous)
+        snapshot.save_listing(listing)
+        snapshot.save_groups(repeated_files)
+        snapshot.close()
+    
+    with metrics.phase('sort_groups', len(repeated_files) + len(linked_files)):
+        repeated_files = sort_repeated_files_list(repeated_files)
+        linked_files = sort_repeated_files_list(linked_files)
     # dump_to_json("dump_batch.txt", repeated_files)
 
     # ------ Batch - Write commands to file ---------
     script_name = 'replist' + '.bat' if os.name == 'nt' else '.sh'
 
-    if (len(repeated_files) > 0):
+    if linked_files:
+        print (f'{len(linked_files)} files have hardlinks that are not repeated anywhere else, deleting them frees no space.')
+
+    if (len(repeated_files) > 0 or len(linked_files) > 0):
         print (f'Creating {script_name} at', os.getcwd())
 
-        write_batch_file(repeated_files, files, '.', script_name , '.', link_repeated_files=False)
+        with metrics.phase('script', len(repeated_files) + len(linked_files)) as phase:
+            write_batch_file(repeated_files, all_files, '.', script_name , '.', link_repeated_files=False, linked_files=linked_files)
+            phase['bytes'] = os.path.getsize(script_name)
 
-    else:
+    if args.report:
+        report_format = args.report_format or ('csv' if args.report.lower().endswith('.csv') else 'jsonl')
+        print (f'Writing {report_format} report to {args.report}')
+        with metrics.phase('report', len(repeated_files) + len(linked_files)) as phase:
+            write_report(args.report, repeated_files, linked_files, report_format)
+            phase['bytes'] = os.path.getsize(args.report)
+
+    if not repeated_files:
         print (f'No repeated files.')
     
     
@@ -433,11 +1447,32 @@ def main(argv):
     finish_time = time.time()
     
     # ----------------------------------------------
+    print (', '.join(['%s %.2f s' % (name, phase['wall_time']) for name, phase in metrics.phases.items()]))
     print (f'Finished in { datetime.timedelta( seconds=(finish_time-start_time)//1 )}')
 
+    if args.metrics:
+        metrics.write_json(args.metrics)
+    if args.metrics_prometheus:
+        metrics.write_prometheus(args.metrics_prometheus)
+
  
+def run_profiled(args):
+    """Run main() under cProfile, the hashing processes write their own stats. See write_profile_report"""
+    os.makedirs(args.profile, exist_ok=True)
+    clear_profile_stats(args.profile)
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(main, args)
+    finally:
+        profiler.dump_stats(os.path.join(args.profile, 'parent.prof'))
+        print (f'Profile written to {write_profile_report(args.profile)}')
+
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, sigint_handler)
     
     args = parse_arguments()
-    main(args)
+    if args.profile:
+        run_profiled(args)
+    else:
+        main(args)
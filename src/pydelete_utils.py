@@ -1,8 +1,11 @@
-import time, os, math
+import time, os, sys, math, struct, io, glob, pstats
 
 from pathlib import Path
 
-import win32file, winioctlcon, struct
+if os.name == 'nt':
+    import win32file, winioctlcon
+else:
+    import fcntl
 
 class timed_tigger():
     """A utility class that can be used to trigger an event at a specified rate."""
@@ -164,6 +167,79 @@ def GET_RETRIEVAL_POINTERS(path):
     
     return data
 
+# struct fiemap and struct fiemap_extent from linux/fiemap.h
+FIEMAP_HEADER_FORMAT    = "=QQLLLL"     # fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count, fm_reserved
+FIEMAP_EXTENT_FORMAT    = "=QQQ16xL12x" # fe_logical, fe_physical, fe_length, fe_reserved64[2], fe_flags, fe_reserved[3]
+FIEMAP_MAX_OFFSET       = 0xFFFFFFFFFFFFFFFF
+FS_IOC_FIEMAP           = 0xC020660B    # _IOWR('f', 11, struct fiemap)
+
+def FIEMAP(path, extent_count = 1):
+    """
+    FIEMAP(path, extent_count)
+    Returns [MappedExtents, *Extents[MappedExtents]], Extents = (Logical, Physical, Length, Flags)
+    The values of Logical, Physical and Length are in bytes.
+
+    https://www.kernel.org/doc/html/latest/filesystems/fiemap.html
+    Physical is the offset of an extent from the start of the block device, the Linux counterpart of the LCN
+    returned by GET_RETRIEVAL_POINTERS. Only the first extent_count extents of the file are returned.
+    Files without data on disk yet (empty, inline in the inode, delayed allocation) have no extents.
+
+    The file is opened with O_NONBLOCK and O_NOFOLLOW, opening a FIFO doesn't wait for a writer and a symlink
+    raises ELOOP instead of mapping its target.
+
+    Raises OSError when the file can't be opened or the filesystem doesn't support FIEMAP (errno EOPNOTSUPP or ENOTTY).
+    """
+    header_size = struct.calcsize(FIEMAP_HEADER_FORMAT)
+    extent_size = struct.calcsize(FIEMAP_EXTENT_FORMAT)
+
+    buffer = bytearray(header_size + extent_size*extent_count)
+    struct.pack_into(FIEMAP_HEADER_FORMAT, buffer, 0, 0, FIEMAP_MAX_OFFSET, 0, 0, extent_count, 0)
+
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK | os.O_NOFOLLOW)
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buffer, True)
+    finally:
+        os.close(fd)
+
+    mapped_extents = struct.unpack_from(FIEMAP_HEADER_FORMAT, buffer, 0)[3]
+
+    data = [mapped_extents]
+    for i in range(mapped_extents):
+        data.append(struct.unpack_from(FIEMAP_EXTENT_FORMAT, buffer, header_size + extent_size*i))
+
+    return data
+
+_rotational = {}
+
+def is_rotational(dev):
+    """
+    Tell if a device is a spinning disk from /sys/dev/block/<major>:<minor>/queue/rotational. Partitions use the queue of their disk.
+
+    Parameters:
+        dev:        st_dev of a file
+
+    Returns:
+        bool or None: None when it can't be told (not Linux, network and virtual filesystems, ...)
+    """
+    if dev in _rotational:
+        return _rotational[dev]
+
+    value = None
+    if sys.platform.startswith('linux'):
+        block = f'/sys/dev/block/{os.major(dev)}:{os.minor(dev)}'
+
+        # The kernel resolves the symlink before "..", so this is the disk of a partition
+        for path in (os.path.join(block, 'queue', 'rotational'), os.path.join(block, '..', 'queue', 'rotational')):
+            try:
+                with open(path) as f:
+                    value = f.read().strip() == '1'
+                break
+            except OSError:
+                continue
+
+    _rotational[dev] = value
+    return value
+
 # ---- Functions - Misc -------------------------------------------------------
 def dump_to_json(path, obj):
     """
@@ -290,3 +366,48 @@ def lsd_radix_sort(iterable, *, key=None):
         iterable = [item for sublist in bins for item in sublist]  # Flatten the bins into a new list of items.
         
     return iterable
+
+def clear_profile_stats(directory):
+    """Remove the .prof files of a previous run from a profile directory, so write_profile_report only merges the ones of this run"""
+    for path in glob.glob(os.path.join(directory, '*.prof')):
+        os.remove(path)
+
+def write_profile_report(directory, parent_stats = 'parent.prof', report = 'report.txt', top = 40):
+    """
+    Merge the cProfile stats of the hashing workers and write a report with them next to the ones of the parent
+
+    Parameters:
+        directory:      Directory with the parent stats and the <worker>-<pid>.prof files of QueuedFileHasher_mp
+        parent_stats:   Name of the stats file of the parent process
+        report:         Name of the text report, the merged stats of the workers are also saved as workers.prof
+        top:            Number of functions listed in each section
+
+    Return:
+        str:            Path of the report
+    """
+    worker_stats = [path for path in sorted(glob.glob(os.path.join(directory, '*.prof')))
+                    if os.path.basename(path) not in (parent_stats, 'workers.prof')]
+
+    output = io.StringIO()
+    # (title, stats files, file to save the merged stats to)
+    sections = [('Parent process', [os.path.join(directory, parent_stats)], None),
+                (f'Hashing workers ({len(worker_stats)} processes merged)', worker_stats, 'workers.prof')]
+
+    for title, paths, merged in sections:
+        paths = [path for path in paths if os.path.exists(path)]
+        output.write(f'==== {title} ====\n')
+        if not paths:
+            output.write('No stats\n\n')
+            continue
+
+        stats = pstats.Stats(*paths, stream=output)
+        if merged:
+            stats.dump_stats(os.path.join(directory, merged))
+        stats.sort_stats('cumulative').print_stats(top)
+        stats.sort_stats('tottime').print_stats(top)
+
+    path = os.path.join(directory, report)
+    with open(path, 'w') as f:
+        f.write(output.getvalue())
+
+    return path
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import json, sqlite3
+
+from pathlib import Path
+
+
+class Snapshot():
+    """
+    State of a previous run stored in a sqlite database, for an incremental rescan.
+
+    It keeps the listing of each directory with its mtime and the repeated files that were found. The digests
+    of the files are kept by a HashCache, that can use the same database file.
+    """
+
+    def __init__(self, path):
+        """
+        Open or create the snapshot database
+
+        Parameters:
+            path:           Path to the sqlite file
+        """
+        self.path = Path(path)
+
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS dirs (
+                path        TEXT    NOT NULL PRIMARY KEY,
+                mtime_ns    INTEGER NOT NULL,
+                files       TEXT    NOT NULL,
+                subdirs     TEXT    NOT NULL
+            ) WITHOUT ROWID""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS groups (
+                hash        TEXT    NOT NULL,
+                size        INTEGER NOT NULL,
+                path        TEXT    NOT NULL
+            )""")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def load_listing(self):
+        """
+        Return the directories of the previous run
+
+        Return:
+            dict:       { directory: (mtime_ns, [file names], [subdirectory names]), ... }
+        """
+        listing = {}
+        for path, mtime_ns, files, subdirs in self.db.execute('SELECT path, mtime_ns, files, subdirs FROM dirs'):
+            listing[path] = (mtime_ns, json.loads(files), json.loads(subdirs))
+        return listing
+
+    def save_listing(self, listing):
+        """Replace the directories with the ones of this run, { directory: (mtime_ns, [file names], [subdirectory names]), ... }"""
+        self.db.execute('DELETE FROM dirs')
+        self.db.executemany('INSERT INTO dirs VALUES (?, ?, ?, ?)',
+                            ((path, mtime_ns, json.dumps(files), json.dumps(subdirs)) for path, (mtime_ns, files, subdirs) in listing.items()))
+        self.db.commit()
+
+    def load_groups(self):
+        """
+        Return the repeated files of the previous run
+
+        Return:
+            dict:       { hash: {[files], size}, ... } files are strings
+        """
+        groups = {}
+        for digest, size, path in self.db.execute('SELECT hash, size, path FROM groups ORDER BY rowid'):
+            groups.setdefault(digest, {'size': size, 'files': []})['files'].append(path)
+        return groups
+
+    def save_groups(self, repeated):
+        """Replace the repeated files with the ones of this run, { hash: {[files], size}, ... }"""
+        self.db.execute('DELETE FROM groups')
+        self.db.executemany('INSERT INTO groups VALUES (?, ?, ?)',
+                            ((digest, group['size'], str(file)) for digest, group in repeated.items() for file in group['files']))
+        self.db.commit()
+
+    def __bool__(self):
+        """False for a snapshot without any run yet"""
+        return self.db.execute('SELECT 1 FROM dirs LIMIT 1').fetchone() is not None
+
+
+def diff_groups(old, new):
+    """
+    Compare the repeated files of two runs
+
+    Parameters:
+        old:        { hash: {[files], size}, ... } of the previous run
+        new:        { hash: {[files], size}, ... } of this run
+
+    Return:
+        dict:       {added: [hash, ...], removed: [hash, ...], changed: {hash: {added: [files], removed: [files]}, ...}}
+    """
+    diff = {'added': [], 'removed': [], 'changed': {}}
+
+    for digest, group in new.items():
+        if digest not in old:
+            diff['added'].append(digest)
+            continue
+
+        files = set([str(file) for file in group['files']])
+        old_files = set([str(file) for file in old[digest]['files']])
+        if files != old_files:
+            diff['changed'][digest] = {'added': sorted(files - old_files), 'removed': sorted(old_files - files)}
+
+    diff['removed'] = [digest for digest in old if digest not in new]
+
+    return diff